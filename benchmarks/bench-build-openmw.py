@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Measure build-openmw's own overhead against tiny, local stand-ins for its
+dependencies, so changes that slow down the orchestration (and especially
+the every-few-minutes no-op path) can be caught.
+
+Everything happens in a temporary directory: bare git repos with small
+CMake projects play OSG, Bullet, and OpenMW, and small configure-and-make
+projects play FFmpeg and Qt.  Nothing touches the network.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), "build-openmw.py")
+RESULTS_DIR = os.path.join(HERE, "results")
+NOOP_RUNS = 5
+MAX_REGRESSION = 25
+PROG = "bench-build-openmw"
+
+CMAKE_LIB = """cmake_minimum_required(VERSION 3.10)
+project({name} C)
+add_library({target} SHARED a.c)
+install(TARGETS {target} LIBRARY DESTINATION lib)
+"""
+CMAKE_EXE = """cmake_minimum_required(VERSION 3.10)
+project({name} C)
+add_executable({target} main.c b.c)
+install(TARGETS {target} RUNTIME DESTINATION bin)
+"""
+CONFIGURE = """#!/bin/sh
+prefix=/usr/local
+for arg in "$@"; do
+    case "$arg" in
+        --prefix=*) prefix="${{arg#--prefix=}}" ;;
+    esac
+done
+cat > Makefile <<EOF
+CC ?= cc
+all: {target}
+{target}: main.c
+\t\\$(CC) -o {target} main.c
+install: {target}
+\tmkdir -p $prefix/bin && cp {target} $prefix/bin/
+clean:
+\trm -f {target}
+EOF
+"""
+# name: (kind, target, tag, branch)
+STAND_INS = {
+    "osg-openmw": ("cmake-lib", "osg", None, "3.6"),
+    "bullet": ("cmake-lib", "LinearMath", "3.17", None),
+    "ffmpeg": ("configure", "ffmpeg", "n4.4.1", None),
+    "qt5": ("configure", "qmake", "5.15.0", None),
+    "openmw": ("cmake-exe", "openmw", None, None),
+}
+
+
+def git(*args, cwd=None) -> str:
+    return subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost"]
+        + list(args),
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout.decode()
+
+
+def make_remotes(root: str) -> dict:
+    """Create a bare repo for each stand-in and return their paths."""
+    remotes = {}
+    for name, (kind, target, tag, branch) in STAND_INS.items():
+        work = os.path.join(root, "work", name)
+        os.makedirs(work)
+        git("init", "-q", cwd=work)
+        if kind == "cmake-lib":
+            files = {
+                "CMakeLists.txt": CMAKE_LIB.format(name=name, target=target),
+                "a.c": "int f(void) { return 1; }\n",
+            }
+        elif kind == "cmake-exe":
+            files = {
+                "CMakeLists.txt": CMAKE_EXE.format(name=name, target=target),
+                "main.c": "int g(void);\nint main(void) { return g(); }\n",
+                "b.c": "int g(void) { return 0; }\n",
+            }
+        else:
+            files = {
+                "configure": CONFIGURE.format(target=target),
+                "main.c": "int main(void) { return 0; }\n",
+                ".gitignore": "/Makefile\n/{}\n".format(target),
+            }
+        for filename, content in files.items():
+            with open(os.path.join(work, filename), "w") as f:
+                f.write(content)
+        if kind == "configure":
+            os.chmod(os.path.join(work, "configure"), 0o755)
+        git("add", "-A", cwd=work)
+        git("commit", "-q", "-m", "init", cwd=work)
+        git("branch", "-M", "master", cwd=work)
+        if tag:
+            git("tag", tag, cwd=work)
+        if branch:
+            git("branch", branch, cwd=work)
+        remotes[name] = os.path.join(root, "remotes", name + ".git")
+        git("clone", "-q", "--bare", work, remotes[name])
+    return remotes
+
+
+def push_change(root: str, remotes: dict, exit_code: int) -> None:
+    """Change one OpenMW translation unit upstream."""
+    work = os.path.join(root, "work", "openmw")
+    with open(os.path.join(work, "b.c"), "w") as f:
+        f.write("int g(void) {{ return {}; }}\n".format(exit_code))
+    git("commit", "-q", "-am", "change b.c", cwd=work)
+    git("push", "-q", remotes["openmw"], "master", cwd=work)
+
+
+def stage_prefix(root: str, name: str, remotes: dict) -> str:
+    """
+    Make an install prefix whose sources are clones of the local remotes,
+    so that every fetch build-openmw does stays on this machine.
+    """
+    prefix = os.path.join(root, name)
+    src = os.path.join(prefix, "src")
+    os.makedirs(src)
+    for lib, remote in remotes.items():
+        git("clone", "-q", remote, os.path.join(src, lib))
+    return prefix
+
+
+def run_script(prefix: str, *args) -> float:
+    cmd = [
+        sys.executable,
+        SCRIPT,
+        "--skip-install-pkgs",
+        "--install-prefix",
+        prefix,
+        "--build-ffmpeg",
+        "--build-qt5",
+    ] + list(args)
+    start = time.monotonic()
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.monotonic() - start
+    if p.returncode != 0:
+        sys.stderr.write(p.stdout.decode(errors="replace"))
+        raise SystemExit("build-openmw failed: " + " ".join(cmd))
+    return elapsed
+
+
+def rejects_recipes(root: str, prefix: str, recipes, *expected) -> bool:
+    """Whether --recipes with these fails, naming what's wrong with them."""
+    path = os.path.join(root, "recipes.json")
+    with open(path, "w") as f:
+        json.dump(recipes, f)
+    cmd = [sys.executable, SCRIPT, "--install-prefix", prefix, "--plan"]
+    p = subprocess.run(
+        cmd + ["--recipes", path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    out = p.stdout.decode(errors="replace")
+    return p.returncode != 0 and all(e in out for e in expected)
+
+
+def last_report(prefix: str) -> dict:
+    reports = os.path.join(prefix, "logs", "reports")
+    newest = sorted(os.listdir(reports))[-1]
+    with open(os.path.join(reports, newest)) as f:
+        return json.load(f)
+
+
+def phase_seconds(report: dict, phase: str) -> float:
+    return sum(p["seconds"] for p in report["phases"] if p["phase"] == phase)
+
+
+def run_benchmarks(root: str, noop_runs: int) -> dict:
+    remotes = make_remotes(root)
+    results = {}
+
+    parallel = stage_prefix(root, "parallel", remotes)
+    results["cold_build_seconds"] = run_script(parallel)
+    serial = stage_prefix(root, "serial", remotes)
+    results["cold_build_serial_seconds"] = run_script(serial, "--parallel-builds", "1")
+    results["scheduler_speedup"] = (
+        results["cold_build_serial_seconds"] / results["cold_build_seconds"]
+    )
+
+    noop = [run_script(parallel) for _ in range(noop_runs)]
+    results["noop_seconds_median"] = statistics.median(noop)
+    results["noop_seconds_min"] = min(noop)
+
+    results["fetch_only_seconds"] = run_script(parallel, "--fetch-only")
+    results["forced_rebuild_seconds"] = run_script(
+        parallel, "--force-openmw", "--force-osg"
+    )
+    report = last_report(parallel)
+    results["forced_rebuild_clean_seconds"] = phase_seconds(report, "clean")
+    results["forced_rebuild_configure_seconds"] = phase_seconds(report, "configure")
+
+    # Incremental rebuilds: after one upstream change, only that file should
+    # be recompiled and the installed binary should have the change.
+    incremental = stage_prefix(root, "incremental", remotes)
+    run_script(incremental, "--incremental")
+    push_change(root, remotes, 7)
+    results["incremental_rebuild_seconds"] = run_script(incremental, "--incremental")
+    openmw = os.path.realpath(os.path.join(incremental, "openmw"))
+    logs = os.path.join(incremental, "logs", os.path.basename(openmw))
+    with open(os.path.join(logs, "compile.log")) as f:
+        compile_log = f.read()
+    exit_code = subprocess.run([os.path.join(openmw, "bin", "openmw")]).returncode
+    results["incremental_correct"] = (
+        "b.c.o" in compile_log and "main.c.o" not in compile_log and exit_code == 7
+    )
+
+    # A forced library is rebuilt even when the artifact cache has it.
+    cache = os.path.join(root, "artifacts")
+    cached = stage_prefix(root, "cached", remotes)
+    run_script(cached, "--artifact-cache", cache)
+    run_script(cached, "--artifact-cache", cache, "--force-osg")
+    results["forced_cached_rebuild_correct"] = os.path.isfile(
+        os.path.join(cached, "logs", "osg-openmw", "compile.log")
+    )
+
+    # Recipe files that don't have the right shape are turned away with what
+    # and where the problem is, rather than half-read.
+    results["bad_recipes_rejected"] = all(
+        [
+            rejects_recipes(
+                root, parallel, {"recipe": {"name": "x"}}, "list of tables"
+            ),
+            rejects_recipes(
+                root,
+                parallel,
+                {"recipe": [{"name": "mygui", "deps": "osg-openmw"}]},
+                "mygui",
+                "'deps'",
+            ),
+            rejects_recipes(
+                root,
+                parallel,
+                {"recipe": [{"name": "mygui", "args": "-DX=1"}]},
+                "mygui",
+                "'args'",
+            ),
+            rejects_recipes(
+                root,
+                parallel,
+                {"recipe": [{"name": "mygui", "enabled": "no"}]},
+                "mygui",
+                "'enabled'",
+            ),
+        ]
+    )
+    return results
+
+
+def script_version() -> str:
+    with open(SCRIPT) as f:
+        for line in f:
+            if line.startswith("VERSION = "):
+                return line.split("=", 1)[1].strip().strip('"')
+    return "unknown"
+
+
+def compare(results: dict, baseline_file: str, max_regression: int) -> bool:
+    """Print how results moved against a baseline; False if they regressed."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)["results"]
+    ok = True
+    for key, value in sorted(results.items()):
+        old = baseline.get(key)
+        if isinstance(value, bool):
+            print("{0:<36} {1}".format(key, value))
+            if old is True and value is not True:
+                ok = False
+            continue
+        if not old:
+            print("{0:<36} {1:9.3f}".format(key, value))
+            continue
+        change = 100 * (value - old) / old
+        print("{0:<36} {1:9.3f} {2:+7.1f}%".format(key, value, change))
+        if key == "noop_seconds_median" and change > max_regression:
+            print("The no-op path got {:.0f}% slower!".format(change))
+            ok = False
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, prog=PROG)
+    parser.add_argument(
+        "--compare",
+        metavar="FILE",
+        help="A previous results file to compare against.",
+    )
+    parser.add_argument(
+        "--max-regression",
+        metavar="PERCENT",
+        type=int,
+        default=MAX_REGRESSION,
+        help="Fail when the no-op path is this much slower than in --compare.  Default: {}".format(
+            MAX_REGRESSION
+        ),
+    )
+    parser.add_argument(
+        "--noop-runs",
+        metavar="N",
+        type=int,
+        default=NOOP_RUNS,
+        help="How many no-op runs to time.  Default: {}".format(NOOP_RUNS),
+    )
+    parser.add_argument(
+        "--results-dir",
+        metavar="DIR",
+        default=RESULTS_DIR,
+        help="Where to store results.  Default: {}".format(RESULTS_DIR),
+    )
+    parsed = parser.parse_args()
+
+    for tool in ("git", "cmake", "make", "cc"):
+        if not shutil.which(tool):
+            raise SystemExit("'{}' is needed to run the benchmarks.".format(tool))
+
+    with tempfile.TemporaryDirectory(prefix="bench-build-openmw-") as root:
+        results = run_benchmarks(root, parsed.noop_runs)
+
+    rev = (
+        subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        .stdout.decode()
+        .strip()
+    )
+    now = datetime.datetime.now()
+    os.makedirs(parsed.results_dir, exist_ok=True)
+    results_file = os.path.join(
+        parsed.results_dir,
+        "{0}-{1}.json".format(now.strftime("%Y%m%d-%H%M%S"), rev or "unknown"),
+    )
+    with open(results_file, "w") as f:
+        json.dump(
+            {
+                "version": script_version(),
+                "git_rev": rev,
+                "date": now.isoformat(timespec="seconds"),
+                "host": platform.node(),
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print("Results written to: " + results_file)
+
+    if parsed.compare:
+        if not compare(results, parsed.compare, parsed.max_regression):
+            sys.exit(1)
+    else:
+        for key, value in sorted(results.items()):
+            print("{0:<36} {1}".format(key, value))
+    if not results["incremental_correct"]:
+        sys.exit("Incremental rebuild did not do what it should have!")
+    if not results["forced_cached_rebuild_correct"]:
+        sys.exit("A forced build was restored from the artifact cache!")
+    if not results["bad_recipes_rejected"]:
+        sys.exit("A bad recipe file was not turned away!")
+
+
+if __name__ == "__main__":
+    main()
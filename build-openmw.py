@@ -1,11 +1,33 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import hashlib
+import io
+import json
 import logging
 import os
+import platform
+import re
 import shutil
+import signal
+import socket
+import stat
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+try:
+    import tomllib
+except ImportError:
+    # Python older than 3.11; recipes can still be read from JSON.
+    tomllib = None
 
 
 BULLET_VERSION = "3.17"
@@ -15,14 +37,96 @@ SDL2_VERSION = "release-2.0.14"
 QT_VERSION = "5.15.0"
 UNSHIELD_VERSION = "1.4.2"
 OPENMW_OSG_BRANCH = "3.6"
-CPUS = os.cpu_count() + 1
+# Rough peak memory, in MiB, of one compile job and one link job.  The
+# OpenMW link is an LTO link, hence the big number.
+MEMORY_PER_JOB = {
+    "default": (512, 1024),
+    "ffmpeg": (256, 1024),
+    "openmw": (1536, 6144),
+    "osg-openmw": (1024, 2048),
+    "qt5": (1024, 2048),
+}
+# Rough size, in MiB, of a build tree, until one has been built with
+# --build-root and its real size is known.
+BUILD_SIZE = {"default": 512, "openmw": 4096, "osg-openmw": 1536}
+BUILD_SIZES_FILE = "build-sizes.json"
+# Where '--build-root auto' looks for a tmpfs, in order.
+RAM_BUILD_ROOTS = ("/dev/shm", "/tmp")
 INSTALL_PREFIX = os.path.join("/", "opt", "build-openmw")
+MANIFEST_FILE = "openmw-manifest.json"
+# Content-addressed blobs that installed OpenMW trees are hardlinked to.
+STORE_DIR = "store"
+GC_KEEP = 5
+# Build farm workers answer on this port, and run distccd on the next one.
+FARM_PORT = 3634
+FARM_TIMEOUT = 3
+# How often --watch asks upstream about the tracked revisions, in seconds.
+WATCH_INTERVAL = 300
+WATCH_SOCKET = "watch.sock"
+# Options that only mean something to the --watch daemon itself, and how
+# many values each takes; the rest are passed on to the builds it runs.
+WATCH_OPTIONS = {"--watch": 0, "--watch-interval": 1, "--watch-socket": 1}
+UNITY_BATCH_SIZE = 16
+# Profiles for PGO builds are kept per OpenMW commit in here.
+PGO_DIR = "pgo"
+PGO_TRAINED = ".trained"
+# Compiler flags for --cpu-profile, and the /proc/cpuinfo flags a CPU needs
+# to run what they build; best first, which is the order a packaged
+# launcher tries them in.
+CPU_PROFILES = collections.OrderedDict(
+    [
+        ("native", ("-march=native", None)),
+        (
+            "x86-64-v3",
+            ("-march=x86-64-v3", "abm avx avx2 bmi1 bmi2 f16c fma movbe xsave"),
+        ),
+        ("x86-64-v2", ("-march=x86-64-v2", "cx16 lahf_lm popcnt sse4_1 sse4_2 ssse3")),
+        ("generic", ("-march=x86-64 -mtune=generic", "")),
+    ]
+)
+# Fastest first; these are what CMAKE_LINKER_TYPE calls them.
+FAST_LINKERS = (("mold", "MOLD"), ("ld.lld", "LLD"), ("ld.gold", "GOLD"))
+# The ones that can write a .gdb_index; GNU ld can't, and only newer mold
+# can, so each is asked first.
+GDB_INDEX_LINKERS = (("ld.lld", "LLD"), ("ld.gold", "GOLD"), ("mold", "MOLD"))
+# Compiler and linker flags for each --debug-info mode.  Only 'inline'
+# leaves debug info in the install tree, the others move it into an
+# <openmw>-debug dir next to it once it's installed.  Split DWARF never
+# goes through the linker, so it's compressed once it's packed instead of
+# by '-gz'; dwp tools don't all read compressed .dwo files, either.
+DEBUG_INFO = collections.OrderedDict(
+    [
+        ("inline", ("", "")),
+        ("split", ("-gsplit-dwarf -ggnu-pubnames", "-gz -Wl,--gdb-index")),
+        ("separate", ("-gz", "-gz")),
+    ]
+)
+DEBUG_DIR_SUFFIX = "-debug"
+OPENMW_GIT_URL = "https://github.com/OpenMW/openmw.git"
+# Make prints "[ 42%]", ninja prints "[123/456]".
+PROGRESS_RE = re.compile(rb"^\[\s*(?:(\d+)%|(\d+)/(\d+))\]")
+LOG_TAIL_LINES = 200
+FETCH_JOBS = 4
+# Build dirs under --build-root that builds are using, and how many bytes
+# each was expected to need.
+BUILD_ROOT_CLAIMS = {}
+BUILD_ROOT_LOCK = threading.Lock()
+# Commands that builds are running, so they can be stopped when one fails.
+CHILDREN = set()
+CHILDREN_LOCK = threading.Lock()
+STOP_BUILDS = threading.Event()
+# Per-phase timings of this run, keyed by (library, phase).
+BUILD_REPORT = {}
+REPORT_LOCK = threading.Lock()
+CURRENT_PHASE = threading.local()
+FETCH_RETRIES = 3
 DESC = "Build OpenMW for your system, install it all to {}.  Also builds the OpenMW fork of OSG, and optionally libBullet, Unshield, and MyGUI, and links against those builds.".format(
     INSTALL_PREFIX
 )
 LOGFMT = "%(asctime)s | %(message)s"
 OUT_DIR = os.getenv("HOME")
 SRC_DIR = os.path.join(INSTALL_PREFIX, "src")
+COMPILER_CACHE_SIZE = "20G"
 ARCH_PKGS = "".split()
 # TODO: conditionally add bullet and unshield
 DEBIAN_PKGS = "cmake git libopenal-dev libbullet-dev libsdl2-dev qt5-default libfreetype6-dev libavcodec-dev libavformat-dev libavutil-dev libswscale-dev cmake build-essential libqt5opengl5-dev libunshield-dev libmygui-dev libbullet-dev".split()
@@ -46,11 +150,339 @@ DEBIAN_PKGS += [
     "libboost-program-options-dev",
     "libboost-system-dev",
 ]
+# Installed packages are only looked at again when one of these changes.
+PACKAGE_DBS = (
+    "/var/lib/dpkg/status",
+    "/var/lib/rpm/rpmdb.sqlite",
+    "/var/lib/rpm/Packages",
+    "/var/lib/pacman/local",
+    "/var/db/xbps",
+)
+PACKAGES_STAMP = ".build-openmw-packages.json"
 VOID_PKGS = "make SDL2-devel boost-devel bullet-devel cmake ffmpeg-devel freetype-devel gcc git libXt-devel libavformat libavutil liblz4-devel libmygui-devel libopenal-devel libopenjpeg2-devel libswresample libswscale libunshield-devel pkg-config python-devel python3-devel qt5-devel sqlite-devel zlib-devel".split()
+# Every library this script builds for OpenMW.  Each is built with "cmake" or
+# "configure" from rev (a tag, SHA, or "origin/<branch>" to follow a branch)
+# of url, into <install prefix>/<name>, against the recipes in deps, and is
+# taken to be installed while its check_file is.  weight is its share of the
+# -j budget next to others building at the same time.  Those marked
+# cpu_profile get the --cpu-profile flags, fast_compile the --fast-compile
+# ones.  More can be added, or these changed, with '--recipes FILE'.
+RECIPES = [
+    {
+        "name": "ffmpeg",
+        "url": "https://github.com/FFmpeg/FFmpeg.git",
+        "rev": FFMPEG_VERSION,
+        "build": "configure",
+        "check_file": "bin/ffmpeg",
+        "weight": 2,
+    },
+    {
+        "name": "osg-openmw",
+        "url": "https://github.com/OpenMW/osg.git",
+        "rev": "origin/" + OPENMW_OSG_BRANCH,
+        "build": "cmake",
+        "args": [
+            "-DBUILD_OSG_PLUGINS_BY_DEFAULT=0",
+            "-DBUILD_OSG_PLUGIN_OSG=1",
+            "-DBUILD_OSG_PLUGIN_DDS=1",
+            "-DBUILD_OSG_PLUGIN_TGA=1",
+            "-DBUILD_OSG_PLUGIN_BMP=1",
+            "-DBUILD_OSG_PLUGIN_JPEG=1",
+            "-DBUILD_OSG_PLUGIN_PNG=1",
+            "-DBUILD_OSG_DEPRECATED_SERIALIZERS=0",
+            "-DBUILD_OSG_EXAMPLES=0",
+        ],
+        "check_file": "lib/libosg.so",
+        "weight": 4,
+        "cpu_profile": True,
+        "fast_compile": True,
+    },
+    {
+        "name": "bullet",
+        "url": "https://github.com/bulletphysics/bullet3.git",
+        "rev": BULLET_VERSION,
+        "build": "cmake",
+        "args": [
+            "-DINSTALL_LIBS=on",
+            "-DBUILD_BULLET3=off",
+            "-DBUILD_CPU_DEMOS=off",
+            "-DBUILD_UNIT_TESTS=off",
+            "-DBUILD_BULLET2_DEMOS=off",
+            "-DBUILD_EXTRAS=off",
+            "-DBUILD_GIMPACTUTILS_EXTRA=off",
+            "-DBUILD_HACD_EXTRA=off",
+            "-DBUILD_INVERSE_DYNAMIC_EXTRA=off",
+            "-DBUILD_OBJ2SDF_EXTRA=off",
+            "-DBUILD_OPENGL3_DEMOS=off",
+            "-DBUILD_BULLET_ROBOTICS_EXTRA=off",
+            "-DBUILD_BULLET_ROBOTICS_GUI_EXTRA=off",
+            "-DBUILD_SHARED_LIBS=on",
+            "-DBULLET2_MULTITHREADING=on",
+            "-DUSE_DOUBLE_PRECISION=on",
+            "-DCMAKE_BUILD_TYPE=Release",
+        ],
+        "check_file": "lib/libLinearMath.so",
+        "weight": 2,
+        "cpu_profile": True,
+    },
+    {
+        "name": "unshield",
+        "url": "https://github.com/twogood/unshield.git",
+        "rev": UNSHIELD_VERSION,
+        "build": "cmake",
+        "check_file": "bin/unshield",
+    },
+    {
+        "name": "mygui",
+        "url": "https://github.com/MyGUI/mygui.git",
+        "rev": MYGUI_VERSION,
+        "build": "cmake",
+        "args": [
+            "-DMYGUI_BUILD_TOOLS=OFF",
+            "-DMYGUI_RENDERSYSTEM=1",
+            "-DMYGUI_BUILD_DEMOS=OFF",
+            "-DMYGUI_BUILD_PLUGINS=OFF",
+            "-DMYGUI_BUILD_TEST_APP=OFF",
+            "-DMYGUI_BUILD_TOOLS=OFF",
+            "-DMYGUI_BUILD_UNITTESTS=OFF",
+        ],
+        "check_file": "include/MYGUI/MyGUI.h",
+    },
+    {
+        "name": "qt5",
+        "url": "https://github.com/qt/qtbase.git",
+        "rev": QT_VERSION,
+        "build": "configure",
+        # ./configure -prefix /usr/local -headerdir /usr/local/include/qt5 -opensource -confirm-license -qt-harfbuzz -fontconfig -no-use-gold-linker -no-mimetype-database -nomake examples -shared > ${deps_dir}/qt5.log 2>&1
+        "args": [
+            "-opensource",
+            "-confirm-license",
+            "-qt-harfbuzz",
+            "-fontconfig",
+            "-no-use-gold-linker",
+            "-no-mimetype-database",
+            "-nomake",
+            "examples",
+            "-shared",
+        ],
+        "check_file": "bin/qmake",
+        "weight": 4,
+    },
+    {
+        "name": "sdl2",
+        "url": "https://github.com/libsdl-org/SDL.git",
+        "rev": SDL2_VERSION,
+        "build": "configure",
+        "check_file": "bin/sdl2-config",
+    },
+]
+# Recipe keys, and their defaults; recipes from a file are checked against
+# these.
+RECIPE_DEFAULTS = {
+    "name": None,
+    "url": None,
+    "rev": "master",
+    "build": "cmake",
+    "args": [],
+    "deps": [],
+    "check_file": None,
+    "weight": 1,
+    "cpu_profile": False,
+    "fast_compile": False,
+    "enabled": True,
+}
+# Env vars that change the outcome of a configure or cmake run.
+FINGERPRINT_ENV = (
+    "CC",
+    "CXX",
+    "CFLAGS",
+    "CXXFLAGS",
+    "CPPFLAGS",
+    "LDFLAGS",
+    "CMAKE_PREFIX_PATH",
+    "PKG_CONFIG_PATH",
+)
+FINGERPRINT_FILE = ".build-openmw-fingerprint"
+STAMP_FILE = ".build-openmw-stamp.json"
+# Compressor commands for packages, "{}" is the thread count.
+PKG_COMPRESSORS = {
+    "zstd": (["zstd", "-q", "-15", "-T{}"], ".tar.zst"),
+    "xz": (["xz", "-6", "-T{}"], ".tar.xz"),
+}
 PROG = "build-openmw"
 VERSION = "1.13"
 
 
+def read_sys_file(path: str):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def cpu_flags() -> str:
+    """The flags of this CPU from /proc/cpuinfo, which '-march=native' goes by."""
+    for line in (read_sys_file("/proc/cpuinfo") or "").splitlines():
+        if line.startswith("flags"):
+            return " ".join(sorted(line.split(":", 1)[1].split()))
+    return platform.machine()
+
+
+def available_cpus() -> int:
+    """CPUs this process may use, honoring affinity and cgroup (v2 or v1) quotas."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = period = None
+    cpu_max = read_sys_file("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, period = cpu_max.split()
+    else:
+        quota = read_sys_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = read_sys_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and quota not in ("max", "-1"):
+        cpus = min(cpus, max(1, int(quota) // int(period)))
+    return cpus
+
+
+def available_memory():
+    """
+    Bytes of memory a build can use: MemAvailable, capped by whatever
+    room the cgroup (v2 or v1) memory limit leaves.  None if unknown.
+    """
+    memory = None
+    for line in (read_sys_file("/proc/meminfo") or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            memory = int(line.split()[1]) * 1024
+    for limit_file, usage_file in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ):
+        limit = read_sys_file(limit_file)
+        usage = read_sys_file(usage_file)
+        # cgroup v1 reports "no limit" as a huge number.
+        if limit and limit.isdigit() and int(limit) < 2**60:
+            room = int(limit) - int(usage or 0)
+            memory = room if memory is None else min(memory, room)
+            break
+    return memory
+
+
+def memory_per_job(libname: str) -> tuple:
+    """MEMORY_PER_JOB for a library; every openmw-<sha> is OpenMW."""
+    if libname.startswith("openmw"):
+        libname = "openmw"
+    return MEMORY_PER_JOB.get(libname, MEMORY_PER_JOB["default"])
+
+
+def job_counts(libname: str, cpus: int, memory=None) -> tuple:
+    """Compile and link parallelism for a library that fits into the given memory."""
+    compile_mem, link_mem = memory_per_job(libname)
+    if memory is None:
+        return cpus, cpus
+    compile_jobs = max(1, min(cpus, memory // (compile_mem * 1024 * 1024)))
+    link_jobs = max(1, min(compile_jobs, memory // (link_mem * 1024 * 1024)))
+    return compile_jobs, link_jobs
+
+
+def is_tmpfs(path: str) -> bool:
+    """Whether path is on a memory-backed filesystem."""
+    path = os.path.realpath(path)
+    fstype = None
+    mount_point = ""
+    for line in (read_sys_file("/proc/mounts") or "").splitlines():
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        point = fields[1]
+        if (path == point or path.startswith(point.rstrip("/") + "/")) and len(
+            point
+        ) >= len(mount_point):
+            mount_point, fstype = point, fields[2]
+    return fstype in ("tmpfs", "ramfs")
+
+
+def auto_build_root():
+    """The first writable tmpfs in RAM_BUILD_ROOTS, or None."""
+    for path in RAM_BUILD_ROOTS:
+        if os.access(path, os.W_OK) and is_tmpfs(path):
+            return path
+    return None
+
+
+def build_size_key(libname: str) -> str:
+    return "openmw" if libname.startswith("openmw") else libname
+
+
+def build_size_estimate(install_prefix: str, libname: str) -> int:
+    """Bytes the build tree of libname is expected to take up."""
+    sizes = read_stamp(os.path.join(install_prefix, BUILD_SIZES_FILE)) or {}
+    key = build_size_key(libname)
+    if key in sizes:
+        return sizes[key]
+    return BUILD_SIZE.get(key, BUILD_SIZE["default"]) * 1024 * 1024
+
+
+def record_build_size(install_prefix: str, libname: str, size: int) -> None:
+    with BUILD_ROOT_LOCK:
+        path = os.path.join(install_prefix, BUILD_SIZES_FILE)
+        sizes = read_stamp(path) or {}
+        sizes[build_size_key(libname)] = size
+        write_stamp(path, sizes)
+
+
+def tree_size(path: str) -> int:
+    """Bytes the files under path take up, which on tmpfs is memory."""
+    size = 0
+    for root, dirs, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return size
+
+
+def claim_build_dir(build_root: str, libname: str, lib_src: str, install_prefix: str):
+    """
+    A build dir for lib_src under build_root, if what its build tree is
+    expected to take up (with some to spare) fits there next to the trees
+    of builds already running, and on a tmpfs, in free memory too.
+    Otherwise None, and it should be built on disk.
+    """
+    need = build_size_estimate(install_prefix, libname) * 5 // 4
+    with BUILD_ROOT_LOCK:
+        claimed = sum(BUILD_ROOT_CLAIMS.values())
+        room = shutil.disk_usage(build_root).free
+        if is_tmpfs(build_root):
+            memory = available_memory()
+            if memory is not None:
+                room = min(room, memory)
+        if need > room - claimed:
+            return None
+        digest = hashlib.sha1(os.path.abspath(lib_src).encode()).hexdigest()[:8]
+        build_dir = os.path.join(
+            build_root,
+            "build-openmw-{0}-{1}".format(os.path.basename(lib_src), digest),
+        )
+        BUILD_ROOT_CLAIMS[build_dir] = need
+    return build_dir
+
+
+def release_build_dir(build_dir: str) -> None:
+    with BUILD_ROOT_LOCK:
+        BUILD_ROOT_CLAIMS.pop(build_dir, None)
+
+
+CPUS = available_cpus() + 1
+
+
 def emit_log(msg: str, level=logging.INFO, quiet=False, *args, **kwargs) -> None:
     """Logging wrapper."""
     if not quiet:
@@ -91,363 +523,2569 @@ def error_and_die(msg: str) -> SystemExit:
     sys.exit(1)
 
 
-def execute_shell(cli_args: list, env=None, verbose=False) -> tuple:
-    """Small convenience wrapper around subprocess.Popen."""
+@contextlib.contextmanager
+def child_process(cli_args: list, **kwargs):
+    """
+    subprocess.Popen, but stop_children() can end it while it runs.  Once
+    builds have been stopped, no new commands are started.
+    """
+    with CHILDREN_LOCK:
+        if STOP_BUILDS.is_set():
+            sys.exit(1)
+        p = subprocess.Popen(cli_args, **kwargs)
+        CHILDREN.add(p)
+    try:
+        yield p
+    finally:
+        with CHILDREN_LOCK:
+            CHILDREN.discard(p)
+
+
+def stop_children() -> None:
+    """
+    Terminate every running command and don't start new ones.  make and
+    ninja pass this on to the compilers they're running.
+    """
+    with CHILDREN_LOCK:
+        STOP_BUILDS.set()
+        for p in CHILDREN:
+            p.terminate()
+
+
+def execute_shell(
+    cli_args: list, env=None, verbose=False, cwd=None, log_file=None, progress=None
+) -> tuple:
+    """
+    Small convenience wrapper around subprocess.Popen.
+
+    With a log_file, output is streamed there as it comes instead of being
+    held in memory, and only the last LOG_TAIL_LINES lines of stdout and
+    stderr are returned.  Make and ninja progress is logged along the way
+    under the given progress label.
+    """
     # TODO: Some way to show the build env when printing the command
     emit_log("EXECUTING: " + " ".join(cli_args), level=logging.DEBUG)
-    if verbose:
-        p = subprocess.Popen(cli_args, env=env)
-    else:
-        p = subprocess.Popen(
-            cli_args, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env
-        )
-    c = p.communicate()
+    if log_file:
+        return stream_shell(cli_args, log_file, env, verbose, cwd, progress)
+    pipes = {}
+    if not verbose:
+        pipes = dict(stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    with child_process(cli_args, env=env, cwd=cwd, **pipes) as p:
+        c = p.communicate()
     return p.returncode, c
 
 
-def build_library(
-    libname,
-    check_file=None,
-    clone_dest=None,
-    cmake=True,
-    cmake_args=None,
-    cmake_target="..",
-    cpus=None,
-    env=None,
-    force=False,
-    install_prefix=INSTALL_PREFIX,
-    git_url=None,
-    make_install=True,
-    patch=None,
-    quiet=False,
-    src_dir=SRC_DIR,
-    verbose=False,
-    version="master",
-):
-    def _configure_make():
-        emit_log("{} building with configure and make!".format(libname))
+@contextlib.contextmanager
+def timed_phase(libname: str, phase: str):
+    """
+    Time a phase of a library's build for the report.  Commands that run
+    in it add their CPU time, peak RSS, and exit codes via record_usage().
+    """
+    with REPORT_LOCK:
+        record = BUILD_REPORT.setdefault(
+            (libname, phase),
+            {
+                "lib": libname,
+                "phase": phase,
+                "seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "max_rss_kb": 0,
+                "exit_codes": [],
+            },
+        )
+    previous = getattr(CURRENT_PHASE, "record", None)
+    CURRENT_PHASE.record = record
+    start = time.monotonic()
+    try:
+        yield record
+    finally:
+        CURRENT_PHASE.record = previous
+        with REPORT_LOCK:
+            record["seconds"] += time.monotonic() - start
 
-        emit_log("{} running make clean ...".format(libname))
-        out, err = execute_shell(["make", "clean"], verbose=verbose)[1]
-        # if err:
-        #     error_and_die(err.decode("utf-8"))
-
-        emit_log("{} running configure ...".format(libname))
-        if libname == "qt5":
-            c = [
-                "./configure",
-                "--prefix={0}/{1}".format(install_prefix, libname),
-                "-opensource",
-                "-confirm-license",
-                "-qt-harfbuzz",
-                "-fontconfig",
-                "-no-use-gold-linker",
-                "-no-mimetype-database",
-                "-nomake",
-                "examples",
-                "-shared",
-            ]
-        else:
-            c = ["./configure", "--prefix={0}/{1}".format(install_prefix, libname)]
 
-        # ./configure -prefix /usr/local -headerdir /usr/local/include/qt5 -opensource -confirm-license -qt-harfbuzz -fontconfig -no-use-gold-linker -no-mimetype-database -nomake examples -shared > ${deps_dir}/qt5.log 2>&1
+def record_usage(exitcode: int, usage) -> None:
+    record = getattr(CURRENT_PHASE, "record", None)
+    if record is None:
+        return
+    with REPORT_LOCK:
+        record["cpu_seconds"] += usage.ru_utime + usage.ru_stime
+        record["max_rss_kb"] = max(record["max_rss_kb"], usage.ru_maxrss)
+        record["exit_codes"].append(exitcode)
 
-        out, err = execute_shell(c, verbose=verbose)[1]
-        if err:
-            error_and_die(err.decode("utf-8"))
 
-        emit_log("{} running make (this will take a while) ...".format(libname))
-        exitcode, output = execute_shell(["make", "-j{}".format(cpus)], verbose=verbose)
-        if exitcode != 0:
-            emit_log(output[1])
-            error_and_die("make exited nonzero!")
+def write_report(path: str, start, argv: list) -> list:
+    """Write the phase timings out as JSON, and return them slowest first."""
+    phases = sorted(BUILD_REPORT.values(), key=lambda r: r["seconds"], reverse=True)
+    report = {
+        "version": VERSION,
+        "argv": argv,
+        "started": start.isoformat(timespec="seconds"),
+        "total_seconds": (datetime.datetime.now() - start).total_seconds(),
+        "phases": phases,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return phases
 
-        emit_log("{} running make install ...".format(libname))
-        out, err = execute_shell(["make", "install"], verbose=verbose)[1]
-        if err:
-            error_and_die(err.decode("utf-8"))
 
-        emit_log("{} installed successfully!".format(libname))
+def stream_shell(cli_args, log_file, env=None, verbose=False, cwd=None, progress=None):
+    with child_process(
+        cli_args, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, cwd=cwd
+    ) as p:
+        tails = (
+            collections.deque(maxlen=LOG_TAIL_LINES),
+            collections.deque(maxlen=LOG_TAIL_LINES),
+        )
+        lock = threading.Lock()
+        reported = [-1]
 
-    def _git_clean_src():
-        os.chdir(os.path.join(src_dir, clone_dest))
-        if force:
-            # TODO: also do this if an explicit fetch flag is used
-            emit_log("Fetching latest sources ...")
-            execute_shell(["git", "fetch", "--all"])[1][0]
-        emit_log("{} executing source clean".format(libname))
-        execute_shell(["git", "checkout", "--", "."], verbose=verbose)
-        execute_shell(["git", "clean", "-df"], verbose=verbose)
+        def _pump(pipe, tail, echo):
+            for line in iter(pipe.readline, b""):
+                tail.append(line)
+                with lock:
+                    log.write(line)
+                    if verbose:
+                        echo.write(line)
+                        echo.flush()
+                    if progress:
+                        match = PROGRESS_RE.match(line)
+                        if match:
+                            if match.group(1):
+                                percent = int(match.group(1))
+                            else:
+                                percent = (
+                                    100 * int(match.group(2)) // int(match.group(3))
+                                )
+                            if percent // 10 > reported[0]:
+                                reported[0] = percent // 10
+                                emit_log("{0}: {1}%".format(progress, percent))
+            pipe.close()
 
-        if libname == "osg-openmw":
-            emit_log(
-                "{} resetting source to the desired rev ({rev})".format(
-                    libname, rev=OPENMW_OSG_BRANCH
-                )
-            )
-            execute_shell(["git", "checkout", OPENMW_OSG_BRANCH], verbose=verbose)
-            execute_shell(
-                ["git", "reset", "--hard", "origin/" + OPENMW_OSG_BRANCH],
-                verbose=verbose,
+        with open(log_file, "ab") as log:
+            log.write(("$ " + " ".join(cli_args) + "\n").encode())
+            stderr = threading.Thread(
+                target=_pump, args=(p.stderr, tails[1], sys.stderr.buffer)
             )
+            stderr.start()
+            _pump(p.stdout, tails[0], sys.stdout.buffer)
+            stderr.join()
+            # wait4() instead of wait() to get this child's own resource usage,
+            # other builds running in parallel don't skew it.
+            status, usage = os.wait4(p.pid, 0)[1:]
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+    record_usage(p.returncode, usage)
+    return p.returncode, (b"".join(tails[0]), b"".join(tails[1]))
 
-        elif libname != "osg-openmw":
-            emit_log(
-                "{} resetting source to the desired rev ({rev})".format(
-                    libname, rev=version
-                )
-            )
-            execute_shell(["git", "checkout", version], verbose=verbose)
-            execute_shell(["git", "reset", "--hard", version], verbose=verbose)
 
-    if not clone_dest:
-        clone_dest = libname
-    if os.path.exists(check_file) and os.path.isfile(check_file) and not force:
-        emit_log("{} found!".format(libname))
+def build_fingerprint(cmd: list, env=None) -> str:
+    """Hash a configure or cmake command line plus the env that affects it."""
+    if env is None:
+        env = os.environ
+    data = {"cmd": cmd, "env": {k: env.get(k) for k in FINGERPRINT_ENV}}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def read_fingerprint(path: str) -> list:
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return []
+
+
+def write_fingerprint(path: str, *fingerprints) -> None:
+    """Store fingerprints, or forget them when none are given."""
+    if not fingerprints:
+        if os.path.exists(path):
+            os.remove(path)
     else:
-        emit_log("{} building now ...".format(libname))
-        if not os.path.exists(os.path.join(src_dir, clone_dest)):
-            emit_log("{} source directory not found, cloning...".format(clone_dest))
-            os.chdir(src_dir)
-            if "osg-openmw" in clone_dest:
-                execute_shell(
-                    ["git", "clone", "-b", OPENMW_OSG_BRANCH, git_url, clone_dest],
-                    verbose=verbose,
-                )[1]
-            else:
-                execute_shell(["git", "clone", git_url, clone_dest], verbose=verbose)[1]
-            if not os.path.exists(os.path.join(src_dir, libname)):
-                error_and_die("Could not clone {} for some reason!".format(clone_dest))
+        with open(path, "w") as f:
+            f.write("\n".join(fingerprints) + "\n")
 
-        if force and os.path.exists(os.path.join(install_prefix, libname)):
-            emit_log("{} forcing removal of previous install".format(libname))
-            shutil.rmtree(os.path.join(install_prefix, libname))
 
-        _git_clean_src()
+def compiler_cache_env(tool: str, cache_dir: str, max_size: str) -> dict:
+    """Env vars that point a compiler cache at our cache dir and size limit."""
+    if tool == "ccache":
+        return {"CCACHE_DIR": cache_dir, "CCACHE_MAXSIZE": max_size}
+    return {"SCCACHE_DIR": cache_dir, "SCCACHE_CACHE_SIZE": max_size}
 
-        if patch:
-            emit_log("Applying patch: " + patch)
-            code = os.system("patch -p1 < " + patch)
-            if code > 0:
-                error_and_die("There was a problem applying the patch!")
 
-        os.chdir(os.path.join(src_dir, clone_dest))
+def ccache_log_counts(stats_log: str) -> tuple:
+    """The (hits, misses) of the compiles ccache wrote to a CCACHE_STATSLOG."""
+    counts = collections.Counter()
+    with contextlib.suppress(FileNotFoundError):
+        with open(stats_log) as f:
+            counts.update(line.strip() for line in f)
+    hits = counts["direct_cache_hit"] + counts["preprocessed_cache_hit"]
+    return hits, counts["cache_miss"]
 
-        if cmake:
-            emit_log("{} building with cmake".format(libname))
-            build_dir = os.path.join(src_dir, clone_dest, "build")
-            if os.path.isdir(build_dir):
-                emit_log("Removing dir tree: " + build_dir)
-                shutil.rmtree(build_dir)
-            os.mkdir(build_dir)
-            os.chdir(build_dir)
-
-            emit_log("{} running cmake ...".format(libname))
-            build_cmd = [
-                "cmake",
-                "-DCMAKE_INSTALL_PREFIX={}/{}".format(install_prefix, libname),
-            ]
-            if cmake_args:
-                build_cmd += cmake_args
-            build_cmd += [cmake_target]
-            exitcode, output = execute_shell(build_cmd, env=env, verbose=verbose)
-            if exitcode != 0:
-                emit_log(output[1])
-                error_and_die("cmake exited nonzero!")
 
-            emit_log("{} running make (this will take a while) ...".format(libname))
-            exitcode, output = execute_shell(
-                ["make", "-j{}".format(cpus)], env=env, verbose=verbose
-            )
-            if exitcode != 0:
-                emit_log(output[1])
-                error_and_die("make exited nonzero!")
+def log_cache_counts(what: str, tool: str, hits: int, misses: int) -> None:
+    emit_log(
+        "{0} {1} stats: {2} hits, {3} misses ({4:.0%} hit rate)".format(
+            what, tool, hits, misses, hits / (hits + misses) if hits + misses else 0
+        )
+    )
 
-            if make_install:
-                emit_log("{} running make install ...".format(libname))
-                out, err = execute_shell(["make", "install"], env=env, verbose=verbose)[
-                    1
-                ]
-                if err:
-                    error_and_die(err.decode("utf-8"))
 
-                emit_log("{} installed successfully".format(libname))
-        else:
-            _configure_make()
+def sccache_counts():
+    """Return the (hits, misses) the sccache server has seen so far, if it can tell."""
+    try:
+        out = execute_shell(["sccache", "--show-stats", "--stats-format", "json"])[1][0]
+        stats = json.loads(out.decode()).get("stats", {})
+        hits = sum(stats.get("cache_hits", {}).get("counts", {}).values())
+        misses = sum(stats.get("cache_misses", {}).get("counts", {}).values())
+    except (OSError, ValueError, AttributeError):
+        return None
+    return hits, misses
 
 
-def get_distro() -> tuple:
-    """Try to run 'lsb_release -d' and return the output."""
-    return execute_shell(["lsb_release", "-d"])[1]
+@functools.lru_cache(maxsize=None)
+def compiler_version() -> str:
+    """First line of 'cc --version' and 'c++ --version', for cache keys."""
+    versions = []
+    for var, compiler in (("CC", "cc"), ("CXX", "c++")):
+        try:
+            cmd = os.environ.get(var, compiler).split() + ["--version"]
+            out = execute_shell(cmd)[1][0]
+            versions.append(out.decode().splitlines()[0])
+        except (OSError, IndexError):
+            versions.append("unknown")
+    return " / ".join(versions)
 
 
-def get_repo_sha(
-    src_dir: str, repo="openmw", rev=None, pull=True, verbose=False
-) -> str:
+@functools.lru_cache(maxsize=None)
+def cmake_version() -> tuple:
     try:
-        os.chdir(os.path.join(src_dir, repo))
-    except FileNotFoundError:
+        out = execute_shell(["cmake", "--version"])[1][0].decode()
+    except OSError:
+        return (0,)
+    match = re.search(r"(\d+)\.(\d+)", out)
+    return tuple(int(n) for n in match.groups()) if match else (0,)
+
+
+def fast_compile_args(batch_size=UNITY_BATCH_SIZE, linker_flag=None) -> list:
+    """
+    CMake args for a unity build, linked with the fastest linker there is
+    that takes linker_flag, if one is given.
+    """
+    args = [
+        "-DCMAKE_UNITY_BUILD=ON",
+        "-DCMAKE_UNITY_BUILD_BATCH_SIZE={}".format(batch_size),
+    ]
+    return args + linker_args(FAST_LINKERS, flag=linker_flag)
+
+
+@functools.lru_cache(maxsize=None)
+def linker_accepts(linker: str, flag: str) -> bool:
+    # Options are read in order, so an unknown one fails before '--version'
+    # gets to print anything and exit.
+    try:
+        return execute_shell([linker, flag, "--version"])[0] == 0
+    except OSError:
         return False
-    if pull:
-        emit_log("Fetching latest sources ...")
-        execute_shell(["git", "fetch", "--all"])[1][0]
 
-    execute_shell(["git", "checkout", rev], verbose=verbose)[1][0]
-    execute_shell(["git", "reset", "--hard", rev], verbose=verbose)[1][0]
 
-    out = execute_shell(["git", "rev-parse", "--short", "HEAD"])[1][0]
-    return out.decode().strip()
+def linker_args(linkers: tuple, flag=None) -> list:
+    """
+    CMake args to link with the first of these linkers that's installed and
+    takes flag, if one is given, or none if none are.  Newer CMake picks the
+    linker with CMAKE_LINKER_TYPE; older ones need '-fuse-ld' in the linker
+    flags.
+    """
+    for linker, linker_type in linkers:
+        if shutil.which(linker) and (flag is None or linker_accepts(linker, flag)):
+            if cmake_version() >= (3, 29):
+                return ["-DCMAKE_LINKER_TYPE=" + linker_type]
+            return [
+                "-DCMAKE_{0}_LINKER_FLAGS=-fuse-ld={1}".format(
+                    target, linker_type.lower()
+                )
+                for target in ("EXE", "SHARED", "MODULE")
+            ]
+    return []
 
 
-def install_packages(distro: str, **kwargs) -> bool:
-    quiet = kwargs.pop("quiet", "")
-    verbose = kwargs.pop("verbose", "")
+def merge_flag_args(args: list) -> list:
+    """
+    Join repeated -DCMAKE_..._FLAGS= args into one, where the first one is,
+    so that flags from several places add up instead of the last one winning.
+    """
+    merged = []
+    positions = {}
+    for arg in args:
+        match = re.match(r"-D(CMAKE_\w+_FLAGS)=(.*)", arg)
+        if match and match.group(1) in positions:
+            i = positions[match.group(1)]
+            merged[i] += " " + match.group(2)
+            continue
+        if match:
+            positions[match.group(1)] = len(merged)
+        merged.append(arg)
+    return merged
 
-    emit_log(
-        "Attempting to install dependency packages, please enter your sudo password as needed...",
-        quiet=quiet,
-    )
-    user_uid = os.getuid()
-    # TODO: install system OSG as needed..
-    if "void" in distro.lower():
-        emit_log("Distro detected as 'Void Linux'")
-        cmd = ["xbps-install", "--yes"] + VOID_PKGS
-        if user_uid > 0:
-            cmd = ["sudo"] + cmd
-        out, err = execute_shell(cmd, verbose=verbose)[1]
-    elif "arch" in distro.lower():
-        emit_log("Distro detected as 'Arch Linux'")
-        cmd = ["pacman", "-sy"] + ARCH_PKGS
-        if user_uid > 0:
-            cmd = ["sudo"] + cmd
-        out, err = execute_shell(cmd, verbose=verbose)[1]
-    elif "debian" in distro.lower():
-        emit_log("Distro detected as 'Debian'")
-        if user_uid > 0:
-            cmd = ["sudo", "apt-get", "install", "-y", "--force-yes"] + DEBIAN_PKGS
-        else:
-            cmd = ["apt-get", "install", "-y", "--force-yes"] + DEBIAN_PKGS
-        out, err = execute_shell(cmd, verbose=verbose)[1]
-    elif "devuan" in distro.lower():
-        emit_log("Distro detected as 'Devuan'")
-        # Debian packages should just work in this case.
-        if user_uid > 0:
-            cmd = ["sudo", "apt-get", "install", "-y", "--force-yes"] + DEBIAN_PKGS
-        else:
-            cmd = ["apt-get", "install", "-y", "--force-yes"] + DEBIAN_PKGS
-        out, err = execute_shell(cmd, verbose=verbose)[1]
-    elif "ubuntu" in distro.lower() or "mint" in distro.lower():
-        emit_log("Distro detected as 'Mint' or 'Ubuntu'!")
-        msg = "Package installation completed!"
-        if user_uid > 0:
-            cmd = ["sudo", "apt-get", "install", "-y", "--force-yes"] + UBUNTU_PKGS
-        else:
-            cmd = ["apt-get", "install", "-y", "--force-yes"] + UBUNTU_PKGS
-        out, err = execute_shell(cmd, verbose=verbose)[1]
-    elif "fedora" in distro.lower():
-        emit_log("Distro detected as 'Fedora'")
-        if user_uid > 0:
-            # cmd = ["dnf", "groupinstall", "-y", "development-tools"]
-            # out, err = execute_shell(cmd, verbose=verbose)[1]
-            cmd = ["dnf", "install", "-y"] + FEDORA_PKGS
-            out, err = execute_shell(cmd, verbose=verbose)[1]
+
+def debug_info_args(mode: str, gdb_index=True) -> list:
+    """CMake args for a --debug-info mode, without '--gdb-index' if not gdb_index."""
+    cflags, ldflags = DEBUG_INFO[mode]
+    if not gdb_index:
+        ldflags = ldflags.replace("-Wl,--gdb-index", "").strip()
+    args = [
+        "-DCMAKE_{}_FLAGS={}".format(lang, cflags) for lang in ("C", "CXX") if cflags
+    ]
+    args += [
+        "-DCMAKE_{}_LINKER_FLAGS={}".format(target, ldflags)
+        for target in ("EXE", "SHARED", "MODULE")
+        if ldflags
+    ]
+    return args
+
+
+def build_id(path: str):
+    """An ELF file's GNU build ID, or None if it wasn't linked with one."""
+    exitcode, output = execute_shell(["readelf", "-n", path])
+    match = re.search(rb"Build ID: ([0-9a-f]+)", output[0] or b"")
+    return match.group(1).decode() if exitcode == 0 and match else None
+
+
+def separate_debug_info(tree: str, debug_dir: str, dwp=None, threads=1) -> int:
+    """
+    Move the debug info of each ELF file installed in tree into debug_dir,
+    where gdb finds it with debug_dir in its debug-file-directory: as a
+    <program>.dwp of its split DWARF, packed with the dwp tool given, or
+    otherwise as a .build-id/xx/xxxx.debug file.  The files themselves keep
+    split DWARF's skeleton and index, or a debuglink to the '.debug' file.
+    Return how many bytes debug_dir takes up.
+    """
+    if os.path.isdir(debug_dir):
+        shutil.rmtree(debug_dir)
+    os.makedirs(debug_dir)
+    elfs = []
+    for root, dirs, filenames in os.walk(tree):
+        for name in filenames:
+            path = os.path.join(root, name)
+            if not os.path.islink(path) and is_elf(path):
+                elfs.append(path)
+
+    def _separate(path):
+        if dwp:
+            name = os.path.basename(path)
+            packed = os.path.join(debug_dir, name + ".dwp")
+            cmds = [
+                [dwp, "-e", path, "-o", packed],
+                ["objcopy", "--compress-debug-sections", packed],
+            ]
         else:
-            # cmd = ["sudo", "dnf", "groupinstall", "-y", "development-tools"]
-            # out, err = execute_shell(cmd, verbose=verbose)[1]
-            cmd = ["sudo", "dnf", "install", "-y"] + FEDORA_PKGS
-            out, err = execute_shell(cmd, verbose=verbose)[1]
+            build = build_id(path)
+            if not build:
+                emit_log(
+                    "{} has no build ID, leaving its debug info in it".format(path),
+                    level=logging.WARN,
+                )
+                return
+            debug = os.path.join(
+                debug_dir, ".build-id", build[:2], build[2:] + ".debug"
+            )
+            os.makedirs(os.path.dirname(debug), exist_ok=True)
+            cmds = [
+                ["objcopy", "--only-keep-debug", path, debug],
+                ["objcopy", "--strip-debug", "--add-gnu-debuglink=" + debug, path],
+            ]
+        for cmd in cmds:
+            exitcode, output = execute_shell(cmd)
+            if exitcode != 0:
+                error_and_die(
+                    "{0} exited nonzero: {1}".format(
+                        cmd[0], (output[1] or output[0]).decode(errors="replace")
+                    )
+                )
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        list(pool.map(_separate, elfs))
+    with open(os.path.join(debug_dir, "gdbinit"), "w") as f:
+        f.write("set debug-file-directory {}:/usr/lib/debug\n".format(debug_dir))
+    return tree_size(debug_dir)
+
+
+def pgo_args(profile_dir: str, clang: bool, use: bool) -> list:
+    """Compiler flags to build with profiling, or with the profile that gave."""
+    if not use:
+        flags = "-fprofile-generate={} -fprofile-update=atomic".format(profile_dir)
+    elif clang:
+        flags = "-fprofile-use=" + os.path.join(profile_dir, "default.profdata")
     else:
+        flags = "-fprofile-use={} -fprofile-correction -Wno-missing-profile".format(
+            profile_dir
+        )
+    return ["-DCMAKE_C_FLAGS=" + flags, "-DCMAKE_CXX_FLAGS=" + flags]
+
+
+def pgo_train(
+    name: str,
+    command: str,
+    openmw_dir: str,
+    profile_dir: str,
+    clang=False,
+) -> None:
+    """
+    Run the training command against an instrumented OpenMW build, merge what
+    it recorded (clang only, GCC reads its .gcda files as they are), and
+    remove the instrumented build.  The command is ran by the shell, with
+    OPENMW_BIN set to the instrumented binary and OPENMW_PREFIX to its
+    install tree.
+    """
+    log_dir = os.path.join(os.path.dirname(openmw_dir), "logs", name)
+    os.makedirs(log_dir, exist_ok=True)
+    env = dict(
+        os.environ,
+        OPENMW_BIN=os.path.join(openmw_dir, "bin", "openmw"),
+        OPENMW_PREFIX=openmw_dir,
+    )
+    emit_log("{0} running the training command: {1}".format(name, command))
+    with timed_phase(name, "train"):
+        exitcode = execute_shell(
+            ["sh", "-c", command],
+            env=env,
+            cwd=profile_dir,
+            log_file=os.path.join(log_dir, "train.log"),
+        )[0]
+    if exitcode != 0:
         error_and_die(
-            "Your OS is not yet supported!  If you think you know what you are doing, you can use '-S' to continue anyways."
+            "The training command exited nonzero!  See the full log: "
+            + os.path.join(log_dir, "train.log")
         )
-    msg = "Package installation completed"
+    if clang:
+        profiles = [
+            os.path.join(profile_dir, f)
+            for f in os.listdir(profile_dir)
+            if f.endswith(".profraw")
+        ]
+        with timed_phase(name, "merge"):
+            exitcode = execute_shell(
+                ["llvm-profdata", "merge", "-o", "default.profdata"] + profiles,
+                cwd=profile_dir,
+                log_file=os.path.join(log_dir, "merge.log"),
+            )[0]
+        if exitcode != 0:
+            error_and_die("llvm-profdata exited nonzero!")
+    open(os.path.join(profile_dir, PGO_TRAINED), "w").close()
+    shutil.rmtree(openmw_dir)
+    emit_log("{} profile is ready".format(name))
 
-    emit_log(msg)
-    return out, err
 
+def bolt_optimize(name: str, command: str, openmw_dir: str, profile_dir: str) -> None:
+    """
+    Lay out the OpenMW binary by how the training command used it, with BOLT.
+    Its profile is kept with the PGO one and reused while it's there.
+    """
+    log_dir = os.path.join(os.path.dirname(openmw_dir), "logs", name)
+    os.makedirs(log_dir, exist_ok=True)
+    binary = os.path.join(openmw_dir, "bin", "openmw")
+    fdata = os.path.join(profile_dir, "bolt.fdata")
 
-def parse_argv() -> None:
-    """Set up args and parse them."""
-    parser = argparse.ArgumentParser(description=DESC, prog=PROG)
-    parser.add_argument(
-        "--version", action="version", version=VERSION, help=argparse.SUPPRESS
+    def _run(cmd, phase, env=None):
+        with timed_phase(name, phase):
+            exitcode = execute_shell(
+                cmd,
+                env=env,
+                cwd=profile_dir,
+                log_file=os.path.join(log_dir, phase + ".log"),
+            )[0]
+        if exitcode != 0:
+            error_and_die(
+                "{0} exited nonzero!  See the full log: {1}".format(
+                    cmd[0], os.path.join(log_dir, phase + ".log")
+                )
+            )
+
+    if not os.path.isfile(fdata):
+        instrumented = binary + ".instrumented"
+        _run(
+            [
+                "llvm-bolt",
+                binary,
+                "-instrument",
+                "--instrumentation-file=" + fdata,
+                "-o",
+                instrumented,
+            ],
+            "instrument",
+        )
+        emit_log("{0} running the training command: {1}".format(name, command))
+        _run(
+            ["sh", "-c", command],
+            "train",
+            env=dict(os.environ, OPENMW_BIN=instrumented, OPENMW_PREFIX=openmw_dir),
+        )
+        os.remove(instrumented)
+    _run(
+        [
+            "llvm-bolt",
+            binary,
+            "-o",
+            binary + ".bolt",
+            "-data=" + fdata,
+            "-reorder-blocks=ext-tsp",
+            "-reorder-functions=hfsort",
+            "-split-functions",
+            "-split-all-cold",
+            "-dyno-stats",
+        ],
+        "optimize",
+    )
+    os.replace(binary + ".bolt", binary)
+    emit_log("{} binary optimized with BOLT".format(name))
+
+
+def library_seconds(libname: str) -> float:
+    """How long a library took to configure, compile, and install this run."""
+    with REPORT_LOCK:
+        return sum(
+            r["seconds"]
+            for r in BUILD_REPORT.values()
+            if r["lib"] == libname and r["phase"] in ("configure", "compile", "install")
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def distro_id() -> str:
+    try:
+        return get_distro()[0].decode().split(":")[1].strip()
+    except (OSError, IndexError):
+        for line in (read_sys_file("/etc/os-release") or "").splitlines():
+            if line.startswith("PRETTY_NAME="):
+                return line.split("=", 1)[1].strip('"')
+    return "unknown"
+
+
+def artifact_key(libname: str, commit: str, recipe: dict) -> str:
+    """
+    Hash everything that should change a library's install tree: its name,
+    source commit, build arguments, toolchain, distro, and build env.
+    """
+    data = {
+        "lib": libname,
+        "commit": commit,
+        "recipe": recipe,
+        "compiler": compiler_version(),
+        "distro": distro_id(),
+        "env": {k: os.environ.get(k) for k in FINGERPRINT_ENV},
+    }
+    if "-march=native" in json.dumps(recipe):
+        # What that builds for is up to the CPU it's built on, and machines
+        # sharing a cache don't all have the same one.
+        data["cpu"] = cpu_flags()
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def patch_digest(patch):
+    """A patch's hash, shared by library stamps and artifact keys; None without one."""
+    if not patch:
+        return None
+    with open(patch, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def library_artifact_key(libname: str, commit: str, kwargs: dict) -> str:
+    """artifact_key() for a library with these build_library kwargs."""
+    return artifact_key(
+        libname,
+        commit,
+        {
+            "cmake_args": (
+                kwargs.get("cmake_args")
+                if kwargs.get("cmake", True)
+                else configure_command(
+                    libname, kwargs["install_prefix"], kwargs.get("configure_args")
+                )
+            ),
+            "install_prefix": kwargs["install_prefix"],
+            "patch": patch_digest(kwargs.get("patch")),
+        },
+    )
+
+
+def artifact_file(cache_dir: str, name: str, key: str) -> str:
+    return os.path.join(cache_dir, "{0}-{1}.tar.gz".format(name, key))
+
+
+def restore_artifact(cache_dir: str, name: str, key: str, install_prefix: str) -> bool:
+    """Unpack a cached install tree into install_prefix if there is one."""
+    tarball = artifact_file(cache_dir, name, key)
+    if not os.path.isfile(tarball):
+        return False
+    dest = os.path.join(install_prefix, name)
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    with tarfile.open(tarball) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(install_prefix, filter="data")
+        else:
+            tar.extractall(install_prefix)
+    return True
+
+
+def store_artifact(cache_dir: str, name: str, key: str, install_prefix: str) -> None:
+    """
+    Save an install tree to the cache.  The tarball is written under a
+    temporary name and renamed into place, so other machines sharing the
+    cache over NFS never see a partial one.
+    """
+    tarball = artifact_file(cache_dir, name, key)
+    tmp = "{0}.{1}-{2}.tmp".format(tarball, socket.gethostname(), os.getpid())
+    with tarfile.open(tmp, "w:gz") as tar:
+        tar.add(os.path.join(install_prefix, name), arcname=name)
+    os.replace(tmp, tarball)
+
+
+def configure_command(libname: str, install_prefix: str, args=None) -> list:
+    return ["./configure", "--prefix={0}/{1}".format(install_prefix, libname)] + list(
+        args or []
+    )
+
+
+def recipe_value_error(key: str, value):
+    """Say what a recipe key's value should have been, or None if it's fine."""
+    default = RECIPE_DEFAULTS[key]
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            return "true or false"
+    elif isinstance(default, int):
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            return "a whole number above 0"
+    elif isinstance(default, list):
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+            return "a list of strings"
+    elif not isinstance(value, str):
+        return "a string"
+    return None
+
+
+def load_recipes(path: str, recipes: list) -> list:
+    """
+    Read recipes from a JSON or TOML file, as a list under "recipe" (TOML's
+    [[recipe]] tables), and return recipes with them applied: each one
+    changes the keys it sets of the recipe with its name, or is added.
+    Added ones are built unless they say "enabled = false".
+    """
+    try:
+        with open(path, "rb") as f:
+            if path.endswith(".toml"):
+                if tomllib is None:
+                    error_and_die(
+                        "TOML recipes need Python 3.11 or newer, or use JSON!"
+                    )
+                data = tomllib.load(f)
+            else:
+                data = json.loads(f.read().decode())
+    except (OSError, ValueError) as e:
+        error_and_die("Could not read recipes from {0}: {1}".format(path, e))
+    by_name = collections.OrderedDict((r["name"], dict(r)) for r in recipes)
+    loaded = data.get("recipe", []) if isinstance(data, dict) else data
+    if not isinstance(loaded, list) or not all(isinstance(r, dict) for r in loaded):
+        error_and_die(
+            "Recipes in {} must be a list of tables, '[[recipe]]' in TOML!".format(path)
+        )
+    for number, recipe in enumerate(loaded, 1):
+        name = recipe.get("name")
+        what = (
+            "the {} recipe".format(name)
+            if isinstance(name, str)
+            else "recipe {}".format(number)
+        )
+        unknown = sorted(set(recipe) - set(RECIPE_DEFAULTS))
+        if unknown:
+            error_and_die(
+                "Bad recipe in {0}: {1} has unknown keys: {2}".format(
+                    path, what, ", ".join(unknown)
+                )
+            )
+        if "name" not in recipe:
+            error_and_die("Bad recipe in {0}: {1} has no name".format(path, what))
+        for key, value in recipe.items():
+            wanted = recipe_value_error(key, value)
+            if wanted:
+                error_and_die(
+                    "Bad recipe in {0}: {1}'s '{2}' must be {3}, not {4}".format(
+                        path, what, key, wanted, json.dumps(value, default=str)
+                    )
+                )
+        if recipe["name"] in by_name:
+            by_name[recipe["name"]].update(recipe)
+        else:
+            missing = [k for k in ("url", "check_file") if k not in recipe]
+            if missing:
+                error_and_die(
+                    "The {0} recipe needs: {1}".format(
+                        recipe["name"], ", ".join(missing)
+                    )
+                )
+            by_name[recipe["name"]] = dict(recipe)
+    for recipe in by_name.values():
+        if recipe.get("build", "cmake") not in ("cmake", "configure"):
+            error_and_die(
+                "The {} recipe must build with 'cmake' or 'configure'!".format(
+                    recipe["name"]
+                )
+            )
+    return list(by_name.values())
+
+
+def recipe_order(recipes: list) -> list:
+    """Recipes sorted so each comes after what it depends on."""
+    by_name = collections.OrderedDict((r["name"], r) for r in recipes)
+    ordered = []
+    visiting = set()
+
+    def _visit(recipe):
+        if recipe in ordered:
+            return
+        if recipe["name"] in visiting:
+            error_and_die("The {} recipe depends on itself!".format(recipe["name"]))
+        visiting.add(recipe["name"])
+        for dep in recipe.get("deps", []):
+            if dep in by_name:
+                _visit(by_name[dep])
+        ordered.append(recipe)
+
+    for recipe in by_name.values():
+        _visit(recipe)
+    return ordered
+
+
+def prefix_path(install_prefix: str, names) -> str:
+    """CMAKE_PREFIX_PATH for building against these of our libraries."""
+    return ":".join(os.path.join(install_prefix, name) for name in names)
+
+
+def library_stamp(libname: str, commit, kwargs: dict, deps: dict) -> dict:
+    """
+    Everything that goes into a library's install tree: its source commit,
+    build arguments, the env and toolchain it's built with, and the stamps of
+    the libraries it's built against.  kwargs are its build_library kwargs.
+    """
+    env = kwargs.get("env") or os.environ
+    if kwargs.get("cmake", True):
+        args = kwargs.get("cmake_args") or []
+    else:
+        args = configure_command(
+            libname, kwargs["install_prefix"], kwargs.get("configure_args")
+        )
+    return {
+        "commit": commit,
+        "args": args,
+        "env": {k: env.get(k) for k in FINGERPRINT_ENV},
+        "toolchain": compiler_version(),
+        "patch": patch_digest(kwargs.get("patch")),
+        "deps": {name: stamp_digest(stamp) for name, stamp in sorted(deps.items())},
+    }
+
+
+def stamp_digest(stamp: dict) -> str:
+    return hashlib.sha256(json.dumps(stamp, sort_keys=True).encode()).hexdigest()
+
+
+def read_stamp(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_stamp(path: str, stamp: dict) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump(stamp, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def stale_stamp(check_file: str, stamp_file: str, stamp: dict):
+    """
+    Say why a library needs to be built, or return None if it's installed and
+    was built from exactly what its stamp says.  Installs from before there
+    were stamps are taken to be current, as they always have been; see
+    adopt_stamp().  Nothing is written here.
+    """
+    if not os.path.isfile(check_file):
+        return "not installed"
+    stored = read_stamp(stamp_file)
+    if stored is None and stamp["commit"]:
+        return None
+    changed = [k for k in sorted(stamp) if (stored or {}).get(k) != stamp[k]]
+    if changed:
+        return "changed: " + ", ".join(changed)
+    return None
+
+
+def adopt_stamp(check_file: str, stamp_file: str, stamp: dict) -> None:
+    """Give an install from before there were stamps the one it would have had."""
+    if (
+        stamp["commit"]
+        and os.path.isfile(check_file)
+        and read_stamp(stamp_file) is None
+    ):
+        write_stamp(stamp_file, stamp)
+
+
+def looks_like_sha(rev: str) -> bool:
+    return bool(re.fullmatch(r"[0-9a-f]{7,40}", rev))
+
+
+def is_branch(rev: str) -> bool:
+    # Branches are always given with their remote, like OSG's "origin/3.6".
+    return "/" in rev and not looks_like_sha(rev)
+
+
+def update_mirror(mirror_dir: str, git_url: str) -> str:
+    """
+    Create or refresh a bare mirror of a repo in mirror_dir, which clones then
+    borrow objects from.  Several prefixes on one host can share one mirror.
+    """
+    name = os.path.basename(git_url.rstrip("/"))
+    if not name.endswith(".git"):
+        name += ".git"
+    mirror = os.path.join(mirror_dir, name)
+    if os.path.isdir(mirror):
+        emit_log("Updating git mirror: " + mirror)
+        execute_shell(["git", "remote", "update", "--prune"], cwd=mirror)
+    else:
+        emit_log("Creating git mirror: " + mirror)
+        execute_shell(["git", "clone", "--mirror", git_url, mirror])
+    return mirror
+
+
+def clone_repo(
+    git_url: str,
+    dest: str,
+    rev=None,
+    depth=None,
+    blobless=False,
+    git_mirror=None,
+    verbose=False,
+    cwd=None,
+) -> int:
+    """
+    Clone a repo, optionally shallow (just the pinned branch or tag when
+    there is one), blobless, and/or borrowing objects from a local mirror.
+    """
+    cmd = ["git", "clone"]
+    if rev and not looks_like_sha(rev):
+        if rev.startswith("origin/"):
+            rev = rev[len("origin/") :]
+        cmd += ["-b", rev]
+    if depth:
+        cmd += ["--depth", str(depth)]
+    if blobless:
+        cmd.append("--filter=blob:none")
+    if git_mirror:
+        cmd += ["--reference-if-able", update_mirror(git_mirror, git_url)]
+    exitcode = execute_shell(cmd + [git_url, dest], verbose=verbose, cwd=cwd)[0]
+    if exitcode == 0 and depth and rev and looks_like_sha(rev):
+        # A shallow clone only has the tip of the default branch.
+        exitcode = fetch_repo(os.path.join(cwd or "", dest), rev, depth=depth)
+    return exitcode
+
+
+def fetch_repo(repo_dir: str, rev=None, depth=None, git_mirror=None) -> int:
+    """
+    Fetch new sources.  Normally this is a 'git fetch --all', but with a
+    depth only the commits needed for rev are fetched.
+    """
+    if git_mirror:
+        url = execute_shell(["git", "remote", "get-url", "origin"], cwd=repo_dir)[1][0]
+        update_mirror(git_mirror, url.decode().strip())
+    if not depth or not rev:
+        return execute_shell(["git", "fetch", "--all"], cwd=repo_dir)[0]
+
+    fetch = ["git", "fetch", "--depth", str(depth)]
+    if looks_like_sha(rev):
+        return execute_shell(fetch + ["origin", rev], cwd=repo_dir)[0]
+    if "/" in rev:
+        remote, branch = rev.split("/", 1)
+        refspec = "+refs/heads/{0}:refs/remotes/{1}/{0}".format(branch, remote)
+        return execute_shell(fetch + [remote, refspec], cwd=repo_dir)[0]
+    # A bare name is usually a release tag, but could be a branch.
+    refspec = "+refs/tags/{0}:refs/tags/{0}".format(rev)
+    exitcode = execute_shell(fetch + ["origin", refspec], cwd=repo_dir)[0]
+    if exitcode != 0:
+        refspec = "+refs/heads/{0}:refs/remotes/origin/{0}".format(rev)
+        exitcode = execute_shell(fetch + ["origin", refspec], cwd=repo_dir)[0]
+    return exitcode
+
+
+def rev_exists(repo_dir: str, rev: str) -> bool:
+    cmd = ["git", "rev-parse", "--verify", "-q", rev + "^{commit}"]
+    return execute_shell(cmd, cwd=repo_dir)[0] == 0
+
+
+def fetch_sources(
+    sources: list,
+    src_dir: str,
+    workers=FETCH_JOBS,
+    retries=FETCH_RETRIES,
+    depth=None,
+    blobless=False,
+    git_mirror=None,
+) -> None:
+    """
+    Clone or update several repos at once, before anything gets built.
+
+    Each source is a dict with "name", "dest", "git_url", "rev", and "update"
+    keys.  Missing repos are cloned.  Existing ones are only fetched when
+    "update" is set or the rev they should build isn't there yet.
+    """
+    lock = threading.Lock()
+    finished = []
+
+    def _fetch(source):
+        dest = os.path.join(src_dir, source["dest"])
+        for attempt in range(1, retries + 1):
+            start = time.monotonic()
+            if not os.path.isdir(dest):
+                action = "cloned"
+                with timed_phase(source["name"], "clone"):
+                    exitcode = clone_repo(
+                        source["git_url"],
+                        source["dest"],
+                        rev=source["rev"],
+                        depth=depth,
+                        blobless=blobless,
+                        git_mirror=git_mirror,
+                        cwd=src_dir,
+                    )
+                if exitcode != 0 and os.path.isdir(dest):
+                    # Don't leave a half-made clone for the next attempt.
+                    shutil.rmtree(dest)
+            elif source["update"] or not rev_exists(dest, source["rev"]):
+                action = "fetched"
+                with timed_phase(source["name"], "fetch"):
+                    exitcode = fetch_repo(
+                        dest, source["rev"], depth=depth, git_mirror=git_mirror
+                    )
+            else:
+                action = "already up to date"
+                exitcode = 0
+
+            if exitcode == 0:
+                with lock:
+                    finished.append(source["name"])
+                    emit_log(
+                        "[{0}/{1}] {2} {3} ({4:.1f}s)".format(
+                            len(finished),
+                            len(sources),
+                            source["name"],
+                            action,
+                            time.monotonic() - start,
+                        )
+                    )
+                return
+            emit_log(
+                "{0} could not be {1} (attempt {2}/{3})".format(
+                    source["name"], action, attempt, retries
+                ),
+                level=logging.WARN,
+            )
+            if attempt < retries:
+                time.sleep(2**attempt)
+        error_and_die("Giving up on fetching {}!".format(source["name"]))
+
+    emit_log("Fetching {} source repos ...".format(len(sources)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_fetch, sources))
+
+
+def build_library(
+    libname,
+    artifact_cache=None,
+    blobless=False,
+    build_root=None,
+    check_file=None,
+    clone_depth=None,
+    clone_dest=None,
+    cmake=True,
+    cmake_args=None,
+    cmake_target="..",
+    commit=None,
+    compiler_cache=None,
+    configure_args=None,
+    cpus=None,
+    debug_dir=None,
+    dwp=None,
+    env=None,
+    farm=None,
+    farm_jobs=0,
+    fetch=True,
+    force=False,
+    generator=None,
+    incremental=False,
+    install_prefix=INSTALL_PREFIX,
+    git_mirror=None,
+    git_url=None,
+    make_install=True,
+    memory=None,
+    patch=None,
+    quiet=False,
+    src_dir=SRC_DIR,
+    stamp=None,
+    verbose=False,
+    version="master",
+):
+    def _run(cmd, phase, run_env, cwd):
+        with timed_phase(libname, phase):
+            return execute_shell(
+                cmd,
+                env=run_env,
+                verbose=verbose,
+                cwd=cwd,
+                log_file=os.path.join(log_dir, phase + ".log"),
+                progress=(
+                    "{0} {1}".format(libname, phase) if phase == "compile" else None
+                ),
+            )
+
+    def _fail(what, output, phase):
+        tail = (output[1] or output[0]).decode(errors="replace")
+        emit_log("{0} {1} output ended with:\n{2}".format(libname, what, tail))
+        error_and_die(
+            "{0} exited nonzero!  See the full log: {1}".format(
+                what, os.path.join(log_dir, phase + ".log")
+            )
+        )
+
+    def _configure_make():
+        emit_log("{} building with configure and make!".format(libname))
+
+        c = configure_command(libname, install_prefix, configure_args)
+        if compiler_cache:
+            if libname == "ffmpeg":
+                # FFmpeg's configure ignores CC and CXX from the env.
+                c += ["--cc=" + configure_env["CC"], "--cxx=" + configure_env["CXX"]]
+            elif libname == "qt5":
+                if compiler_cache == "ccache":
+                    c.append("-ccache")
+                else:
+                    emit_log(
+                        "{0} can't be built with {1}, it won't be cached".format(
+                            libname, compiler_cache
+                        ),
+                        level=logging.WARN,
+                    )
+
+        # ./configure -prefix /usr/local -headerdir /usr/local/include/qt5 -opensource -confirm-license -qt-harfbuzz -fontconfig -no-use-gold-linker -no-mimetype-database -nomake examples -shared > ${deps_dir}/qt5.log 2>&1
+
+        fingerprint_file = os.path.join(lib_src, FINGERPRINT_FILE)
+        fingerprint = build_fingerprint(c, configure_env)
+        if incremental and read_fingerprint(fingerprint_file) == [fingerprint]:
+            emit_log("{} configure is up to date, skipping it".format(libname))
+        else:
+            write_fingerprint(fingerprint_file)
+            emit_log("{} running make clean ...".format(libname))
+            out, err = _run(["make", "clean"], "configure", configure_env, lib_src)[1]
+            # if err:
+            #     error_and_die(err.decode("utf-8"))
+
+            emit_log("{} running configure ...".format(libname))
+            out, err = _run(c, "configure", configure_env, lib_src)[1]
+            if err:
+                error_and_die(err.decode("utf-8"))
+            write_fingerprint(fingerprint_file, fingerprint)
+
+        emit_log("{} running make (this will take a while) ...".format(libname))
+        exitcode, output = _run(
+            ["make", "-j{}".format(compile_jobs)], "compile", configure_env, lib_src
+        )
+        if exitcode != 0:
+            _fail("make", output, "compile")
+
+        emit_log("{} running make install ...".format(libname))
+        out, err = _run(["make", "install"], "install", configure_env, lib_src)[1]
+        if err:
+            error_and_die(err.decode("utf-8"))
+
+        emit_log("{} installed successfully!".format(libname))
+
+    def _artifact_key(commit):
+        return library_artifact_key(
+            libname,
+            commit,
+            {
+                "cmake": cmake,
+                "cmake_args": cmake_args,
+                "configure_args": configure_args,
+                "install_prefix": install_prefix,
+                "patch": patch,
+            },
+        )
+
+    def _restore(key):
+        with timed_phase(libname, "artifact"):
+            restored = restore_artifact(artifact_cache, libname, key, install_prefix)
+        if restored:
+            if stamp:
+                write_stamp(stamp_file, stamp)
+            emit_log(
+                "{0} restored from the artifact cache ({1})".format(libname, key[:12])
+            )
+        else:
+            emit_log("{0} is not in the artifact cache ({1})".format(libname, key[:12]))
+        return restored
+
+    def _git_clean_src():
+        if force and fetch:
+            emit_log("Fetching latest sources ...")
+            fetch_repo(lib_src, rev, depth=clone_depth, git_mirror=git_mirror)
+        emit_log("{} executing source clean".format(libname))
+        _run(["git", "checkout", "--", "."], "clean", None, lib_src)
+        clean_cmd = ["git", "clean", "-df"]
+        if incremental:
+            # Keep the build tree and what it was configured with.
+            clean_cmd += ["-e", "/build", "-e", "/" + FINGERPRINT_FILE]
+        _run(clean_cmd, "clean", None, lib_src)
+
+        if rev.startswith("origin/"):
+            # Follow a branch, like OSG's.
+            branch = rev[len("origin/") :]
+            emit_log(
+                "{} resetting source to the desired rev ({rev})".format(
+                    libname, rev=branch
+                )
+            )
+            _run(["git", "checkout", branch], "clean", None, lib_src)
+            _run(["git", "reset", "--hard", rev], "clean", None, lib_src)
+
+        else:
+            emit_log(
+                "{} resetting source to the desired rev ({rev})".format(
+                    libname, rev=version
+                )
+            )
+            _run(["git", "checkout", version], "clean", None, lib_src)
+            _run(["git", "reset", "--hard", version], "clean", None, lib_src)
+
+    if not clone_dest:
+        clone_dest = libname
+    # Nothing in here may chdir; several of these can run at once.
+    lib_src = os.path.join(src_dir, clone_dest)
+    rev = version
+    compile_jobs, link_jobs = job_counts(libname, cpus, memory)
+    # make can't run links any narrower than compiles, so when memory holds
+    # links back, ninja keeps the compiles from being held back too.
+    to_ninja = (
+        generator is None
+        and cmake
+        and link_jobs < compile_jobs
+        and shutil.which("ninja") is not None
+    )
+    generator = "ninja" if to_ninja else generator or "make"
+    if not cmake or generator != "ninja":
+        # Only ninja has job pools, with make every job can be a link.
+        compile_jobs = link_jobs
+    configure_env = env
+    if compiler_cache:
+        configure_env = dict(os.environ if env is None else env)
+        for var, compiler in (("CC", "cc"), ("CXX", "c++")):
+            configure_env[var] = "{0} {1}".format(
+                compiler_cache, configure_env.get(var, compiler)
+            )
+    stamp_file = os.path.join(install_prefix, libname, STAMP_FILE)
+    if stamp is None:
+        stale = None if os.path.isfile(check_file) else "not installed"
+    else:
+        stale = stale_stamp(check_file, stamp_file, stamp)
+        if not stale:
+            adopt_stamp(check_file, stamp_file, stamp)
+    if not stale and not force:
+        emit_log("{} found!".format(libname))
+    else:
+        if stale and not force:
+            emit_log("{0} needs to be built ({1})".format(libname, stale))
+        emit_log("{} building now ...".format(libname))
+        # Logs from the last build of this library make way for new ones.
+        log_dir = os.path.join(install_prefix, "logs", libname)
+        if os.path.isdir(log_dir):
+            shutil.rmtree(log_dir)
+        os.makedirs(log_dir)
+        if to_ninja:
+            emit_log(
+                "{0} will be built with ninja rather than make, there's memory for {1} compile jobs but only {2} link jobs".format(
+                    libname, compile_jobs, link_jobs
+                )
+            )
+        if memory is not None and cmake and generator == "ninja":
+            emit_log(
+                "{0} will use {1} compile and {2} link jobs ({3} MiB of memory to work with)".format(
+                    libname, compile_jobs, link_jobs, memory // (1024 * 1024)
+                )
+            )
+        elif memory is not None:
+            emit_log(
+                "{0} will use {1} jobs ({2} MiB of memory to work with)".format(
+                    libname, compile_jobs, memory // (1024 * 1024)
+                )
+            )
+        stats_log = None
+        if compiler_cache == "ccache":
+            # Only what this library's compiles did goes in here, unlike
+            # ccache's own counters, which builds running alongside add to.
+            stats_log = os.path.join(log_dir, "ccache-stats.log")
+            env = dict(os.environ if env is None else env, CCACHE_STATSLOG=stats_log)
+            configure_env = dict(configure_env, CCACHE_STATSLOG=stats_log)
+        key = None
+        if artifact_cache and commit and not force:
+            # The commit was looked up upstream, so a cached library needs
+            # no clone, fetch, or checkout.
+            key = _artifact_key(commit)
+            if _restore(key):
+                return
+
+        if not os.path.exists(lib_src):
+            if not fetch:
+                error_and_die("The {} source hasn't been fetched!".format(clone_dest))
+            emit_log("{} source directory not found, cloning...".format(clone_dest))
+            clone_repo(
+                git_url,
+                clone_dest,
+                # Full clones have always started out on the default branch.
+                rev=rev if clone_depth or rev.startswith("origin/") else None,
+                depth=clone_depth,
+                blobless=blobless,
+                git_mirror=git_mirror,
+                verbose=verbose,
+                cwd=src_dir,
+            )
+            if not os.path.exists(lib_src):
+                error_and_die("Could not clone {} for some reason!".format(clone_dest))
+
+        if os.path.exists(os.path.join(install_prefix, libname)):
+            emit_log("{} removing the previous install".format(libname))
+            shutil.rmtree(os.path.join(install_prefix, libname))
+
+        _git_clean_src()
+
+        if patch:
+            emit_log("Applying patch: " + patch)
+            code = _run(["patch", "-p1", "-i", patch], "patch", env, lib_src)[0]
+            if code > 0:
+                error_and_die("There was a problem applying the patch!")
+
+        if artifact_cache:
+            head = execute_shell(["git", "rev-parse", "HEAD"], cwd=lib_src)[1][0]
+            head = head.decode().strip()
+            if key is None or head != commit:
+                key = _artifact_key(head)
+                # A forced build is a rebuild, even of a cached library, and
+                # replaces whatever the cache had for it.
+                if not force and _restore(key):
+                    return
+
+        if cmake:
+            emit_log("{} building with cmake".format(libname))
+            build_dir = disk_build_dir = os.path.join(lib_src, "build")
+            if build_root:
+                build_dir = claim_build_dir(
+                    build_root, libname, lib_src, install_prefix
+                )
+                if build_dir:
+                    emit_log("{0} building in {1}".format(libname, build_dir))
+                else:
+                    emit_log(
+                        "{0} won't fit in {1}, building on disk".format(
+                            libname, build_root
+                        )
+                    )
+                    build_dir = disk_build_dir
+            launcher = compiler_cache
+            if farm:
+                # Other hosts compile, this one preprocesses and links.
+                compile_jobs += farm_jobs
+                if compiler_cache == "ccache":
+                    env = dict(os.environ if env is None else env, CCACHE_PREFIX=farm)
+                else:
+                    launcher = farm
+                emit_log(
+                    "{0} compiles go through {1}, -j{2}".format(
+                        libname, farm, compile_jobs
+                    )
+                )
+            build_cmd = [
+                "cmake",
+                "-DCMAKE_INSTALL_PREFIX={}/{}".format(install_prefix, libname),
+            ]
+            if generator == "ninja":
+                # Only ninja knows about job pools, so only ninja can keep
+                # the link step from running as wide as compiles do.
+                build_cmd += [
+                    "-G",
+                    "Ninja",
+                    "-DCMAKE_JOB_POOLS=compile={0};link={1}".format(
+                        compile_jobs, link_jobs
+                    ),
+                    "-DCMAKE_JOB_POOL_COMPILE=compile",
+                    "-DCMAKE_JOB_POOL_LINK=link",
+                ]
+                compile_cmd = ["cmake", "--build", ".", "-j", str(compile_jobs)]
+                install_cmd = ["cmake", "--install", "."]
+            else:
+                compile_cmd = ["make", "-j{}".format(compile_jobs)]
+                install_cmd = ["make", "install"]
+            if launcher:
+                build_cmd += [
+                    "-DCMAKE_C_COMPILER_LAUNCHER=" + launcher,
+                    "-DCMAKE_CXX_COMPILER_LAUNCHER=" + launcher,
+                ]
+            if cmake_args:
+                build_cmd += cmake_args
+
+            def _configure_compile(build_dir):
+                # A build tree outside of the source needs to be told where
+                # the source is.
+                cmd = build_cmd + [
+                    (
+                        cmake_target
+                        if build_dir == disk_build_dir
+                        else os.path.normpath(
+                            os.path.join(disk_build_dir, cmake_target)
+                        )
+                    )
+                ]
+                fingerprint_file = os.path.join(build_dir, FINGERPRINT_FILE)
+                # OpenMW's install prefix changes with every SHA and job pools
+                # with the memory that's free, which only calls for a cmake
+                # re-run and not for a fresh build tree.
+                tree_fingerprint = build_fingerprint(
+                    [a for a in cmd[2:] if not a.startswith("-DCMAKE_JOB_POOL")], env
+                )
+                fingerprint = build_fingerprint(cmd, env)
+                stored = read_fingerprint(fingerprint_file) if incremental else []
+
+                if stored[:1] == [tree_fingerprint]:
+                    emit_log("{} reusing build tree: {}".format(libname, build_dir))
+                elif os.path.isdir(build_dir):
+                    if incremental:
+                        emit_log("{} build configuration changed".format(libname))
+                    emit_log("Removing dir tree: " + build_dir)
+                    shutil.rmtree(build_dir)
+                if not os.path.isdir(build_dir):
+                    os.mkdir(build_dir)
+
+                if stored == [tree_fingerprint, fingerprint]:
+                    # make and ninja re-run cmake by themselves if any
+                    # CMakeLists.txt changed.
+                    emit_log("{} cmake is up to date, skipping it".format(libname))
+                else:
+                    emit_log("{} running cmake ...".format(libname))
+                    exitcode, output = _run(cmd, "configure", env, build_dir)
+                    if exitcode != 0:
+                        return "cmake", output, "configure"
+                    write_fingerprint(fingerprint_file, tree_fingerprint, fingerprint)
+
+                emit_log(
+                    "{0} running {1} (this will take a while) ...".format(
+                        libname, generator
+                    )
+                )
+                exitcode, output = _run(compile_cmd, "compile", env, build_dir)
+                if exitcode != 0:
+                    return generator, output, "compile"
+                return None
+
+            failure = _configure_compile(build_dir)
+            if (
+                failure
+                and build_dir != disk_build_dir
+                and b"No space left on device" in b"".join(o or b"" for o in failure[1])
+            ):
+                emit_log(
+                    "{0} ran out of room in {1}, building on disk instead".format(
+                        libname, build_root
+                    ),
+                    level=logging.WARN,
+                )
+                shutil.rmtree(build_dir, ignore_errors=True)
+                release_build_dir(build_dir)
+                build_dir = disk_build_dir
+                failure = _configure_compile(build_dir)
+            if failure:
+                if build_dir != disk_build_dir and not incremental:
+                    # Don't leave a dead build tree taking up memory.
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                _fail(*failure)
+
+            if make_install:
+                emit_log("{0} running {1} install ...".format(libname, generator))
+                out, err = _run(install_cmd, "install", env, build_dir)[1]
+                if err:
+                    error_and_die(err.decode("utf-8"))
+
+                emit_log("{} installed successfully".format(libname))
+
+            if debug_dir:
+                # Before the build tree goes, since split DWARF is in it.
+                with timed_phase(libname, "debuginfo"):
+                    size = separate_debug_info(
+                        os.path.join(install_prefix, libname),
+                        debug_dir,
+                        dwp=dwp,
+                        threads=cpus or 1,
+                    )
+                emit_log(
+                    "{0} debug info moved to: {1} ({2:.1f} MiB)".format(
+                        libname, debug_dir, size / (1024 * 1024)
+                    )
+                )
+
+            if build_root:
+                record_build_size(install_prefix, libname, tree_size(build_dir))
+                if build_dir != disk_build_dir:
+                    if not incremental:
+                        shutil.rmtree(build_dir)
+                    release_build_dir(build_dir)
+        else:
+            _configure_make()
+
+        if stamp and os.path.isdir(os.path.dirname(stamp_file)):
+            write_stamp(stamp_file, stamp)
+
+        if artifact_cache:
+            with timed_phase(libname, "artifact"):
+                store_artifact(artifact_cache, libname, key, install_prefix)
+            emit_log("{} saved to the artifact cache".format(libname))
+
+        if stats_log:
+            log_cache_counts(libname, compiler_cache, *ccache_log_counts(stats_log))
+
+
+def schedule_builds(jobs: dict, cpus: int, max_parallel=None, memory=None) -> None:
+    """
+    Run build_library jobs as a dependency graph.
+
+    Each job is a dict with "deps", "weight", and "kwargs" keys, and
+    optionally "run", a function to call with just the kwargs instead of
+    build_library.  A job starts as soon as every job it depends on has been
+    installed, and the -j budget (and memory, if known) is split between jobs
+    that start together according to their weight.  Dependencies that aren't part of the graph (a system
+    library, say) are treated as already satisfied.  When a job fails, the
+    ones still running are stopped rather than waited for.
+    """
+    pending = {
+        name: [d for d in job["deps"] if d in jobs] for name, job in jobs.items()
+    }
+    done = set()
+    running = {}
+    used = 0
+    used_memory = 0
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_parallel or len(jobs) or 1
+    ) as pool:
+        while pending or running:
+            ready = [n for n, deps in pending.items() if all(d in done for d in deps)]
+            if max_parallel:
+                ready = ready[: max(0, max_parallel - len(running))]
+            if not ready and not running:
+                error_and_die(
+                    "Dependency cycle between: {}!".format(", ".join(sorted(pending)))
+                )
+
+            total_weight = sum(jobs[n]["weight"] for n in ready)
+            free = max(cpus - used, len(ready))
+            free_memory = None if memory is None else memory - used_memory
+            for name in ready:
+                del pending[name]
+                share = max(1, free * jobs[name]["weight"] // total_weight)
+                memory_share = None
+                if free_memory is not None:
+                    memory_share = free_memory * jobs[name]["weight"] // total_weight
+                emit_log("{0} scheduled with -j{1}".format(name, share))
+                run = jobs[name].get("run", build_library)
+                kwargs = jobs[name]["kwargs"]
+                if run is build_library:
+                    kwargs = dict(kwargs, cpus=share, memory=memory_share)
+                future = pool.submit(run, name, **kwargs)
+                running[future] = (name, share, memory_share or 0)
+                used += share
+                used_memory += memory_share or 0
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                name, share, memory_share = running.pop(future)
+                used -= share
+                used_memory -= memory_share
+                try:
+                    future.result()
+                except BaseException:
+                    stop_children()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+                done.add(name)
+
+
+def farm_status(address: str) -> dict:
+    """Ask a build farm worker ("host" or "host:port") how it's doing."""
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        host, port = address, FARM_PORT
+    with socket.create_connection((host, int(port)), timeout=FARM_TIMEOUT) as conn:
+        status = json.loads(conn.makefile("rb").readline().decode())
+    status["host"] = host
+    status["address"] = address
+    return status
+
+
+def farm_hosts(workers: list) -> tuple:
+    """
+    Ask every worker at once how many cores it has free, and return a
+    DISTCC_HOSTS value that gives each one that many jobs, most free first
+    (distcc fills hosts in order), plus the total number of remote jobs.
+    Workers that don't answer or are fully busy are left out.
+    """
+
+    def _status(address):
+        try:
+            return farm_status(address)
+        except (OSError, ValueError) as e:
+            emit_log(
+                "Build farm worker {0} didn't answer: {1}".format(address, e),
+                level=logging.WARN,
+            )
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(workers) or 1) as pool:
+        statuses = [s for s in pool.map(_status, workers) if s and s["free"] > 0]
+    statuses.sort(key=lambda s: s["free"], reverse=True)
+    for status in statuses:
+        emit_log(
+            "Build farm worker {0}: {1}/{2} cores free".format(
+                status["address"], status["free"], status["cpus"]
+            )
+        )
+    hosts = " ".join(
+        "{0}:{1}/{2}".format(s["host"], s["distcc_port"], s["free"]) for s in statuses
+    )
+    return hosts, sum(s["free"] for s in statuses)
+
+
+def farm_worker(port: int, allow: str, jobs: int) -> None:
+    """
+    Take compile jobs from build-openmw runs on other hosts: run distccd on
+    port + 1, sandboxed in a temporary dir of its own, and answer anyone
+    connecting to port with how many of this host's cores are free.
+    """
+    sandbox = tempfile.mkdtemp(prefix="build-openmw-worker-")
+    distccd = subprocess.Popen(
+        [
+            "distccd",
+            "--daemon",
+            "--no-detach",
+            "--log-stderr",
+            "--port",
+            str(port + 1),
+            "--allow",
+            allow,
+            "--jobs",
+            str(jobs),
+        ],
+        cwd=sandbox,
+        env=dict(os.environ, TMPDIR=sandbox),
+    )
+    # Clean up on a plain 'kill' too, not only ctrl-c.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.settimeout(1)
+    try:
+        server.bind(("", port))
+        server.listen()
+        emit_log(
+            "Build farm worker listening on port {0}, distccd on {1} ({2} jobs, sandbox: {3})".format(
+                port, port + 1, jobs, sandbox
+            )
+        )
+        while distccd.poll() is None:
+            try:
+                conn = server.accept()[0]
+            except socket.timeout:
+                continue
+            with conn:
+                status = {
+                    "version": VERSION,
+                    "cpus": jobs,
+                    "free": max(0, jobs - int(os.getloadavg()[0])),
+                    "distcc_port": port + 1,
+                }
+                conn.sendall(json.dumps(status).encode() + b"\n")
+        error_and_die("distccd exited with code {}!".format(distccd.returncode))
+    finally:
+        server.close()
+        if distccd.poll() is None:
+            distccd.terminate()
+            distccd.wait()
+        shutil.rmtree(sandbox)
+
+
+def watch(
+    argv: list,
+    revs: list,
+    openmw_src: str,
+    install_prefix: str,
+    interval=WATCH_INTERVAL,
+    socket_path=None,
+) -> None:
+    """
+    Check where revs are upstream every interval seconds with 'git ls-remote',
+    and build them whenever one of them moves to a commit that isn't
+    installed yet.  Builds are ran one at a time by this script, with the
+    same argv less the watch options; if the revs move more than once while
+    a build is running, only the newest commits are built next.  Commits
+    that failed to build aren't tried again until upstream moves.  Anyone
+    connecting to socket_path gets the daemon's status as JSON.
+    """
+    build_argv = []
+    skip = 0
+    for arg in argv:
+        if skip:
+            skip -= 1
+            continue
+        name = arg.split("=", 1)[0]
+        if name in WATCH_OPTIONS:
+            skip = WATCH_OPTIONS[name] if "=" not in arg else 0
+            continue
+        build_argv.append(arg)
+    log_dir = os.path.join(install_prefix, "logs", "watch")
+    os.makedirs(log_dir, exist_ok=True)
+
+    def _now():
+        return datetime.datetime.now().isoformat(timespec="seconds")
+
+    cond = threading.Condition()
+    stop = threading.Event()
+    installed = set(read_manifest(install_prefix))
+    status = {
+        "version": VERSION,
+        "interval": interval,
+        "refs": {},
+        "last_poll": None,
+        "queued": None,
+        "building": None,
+        "skipped": 0,
+        "builds": 0,
+        "last_build": None,
+        "failed": None,
+    }
+    child = []
+
+    def _builder():
+        while True:
+            with cond:
+                while status["queued"] is None and not stop.is_set():
+                    cond.wait()
+                if stop.is_set():
+                    return
+                shas = status["queued"]
+                status["queued"] = None
+                status["building"] = {"shas": shas, "started": _now()}
+            log_file = os.path.join(
+                log_dir,
+                "build-{}.log".format(
+                    datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+                ),
+            )
+            emit_log("Building {0}, log: {1}".format(", ".join(shas), log_file))
+            with open(log_file, "wb") as log:
+                proc = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__)] + build_argv,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+                child[:] = [proc]
+                exitcode = proc.wait()
+            manifest = read_manifest(install_prefix)
+            with cond:
+                installed.clear()
+                installed.update(manifest)
+                status["builds"] += 1
+                status["last_build"] = dict(
+                    status["building"],
+                    finished=_now(),
+                    exit_code=exitcode,
+                    log=log_file,
+                )
+                status["building"] = None
+                status["failed"] = status["last_build"] if exitcode != 0 else None
+            emit_log(
+                "Build of {0} {1}".format(
+                    ", ".join(shas),
+                    (
+                        "finished"
+                        if exitcode == 0
+                        else "FAILED ({}), it won't be tried again until upstream moves".format(
+                            exitcode
+                        )
+                    ),
+                )
+            )
+
+    def _status_server():
+        server = socket.socket(socket.AF_UNIX)
+        server.settimeout(1)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+        server.bind(socket_path)
+        server.listen()
+        try:
+            while not stop.is_set():
+                try:
+                    conn = server.accept()[0]
+                except socket.timeout:
+                    continue
+                with conn:
+                    with cond:
+                        data = json.dumps(status, sort_keys=True).encode()
+                    conn.sendall(data + b"\n")
+        finally:
+            server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(socket_path)
+
+    def _stop(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    threads = [
+        threading.Thread(target=_builder, daemon=True),
+        threading.Thread(target=_status_server, daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    emit_log(
+        "Watching {0} every {1}s, status on: {2}".format(
+            ", ".join(revs), interval, socket_path
+        )
+    )
+    while not stop.is_set():
+        refs = {rev: resolve_revision(openmw_src, rev) for rev in revs}
+        with cond:
+            status["last_poll"] = _now()
+            if not all(refs.values()):
+                emit_log(
+                    "Could not look up: "
+                    + ", ".join(r for r, sha in refs.items() if not sha),
+                    level=logging.WARN,
+                )
+            else:
+                shas = list(collections.OrderedDict.fromkeys(refs.values()))
+                building = status["building"] and status["building"]["shas"]
+                failed = status["failed"] and status["failed"]["shas"]
+                if refs != status["refs"]:
+                    emit_log(
+                        "Upstream: "
+                        + ", ".join("{0} {1}".format(r, sha) for r, sha in refs.items())
+                    )
+                status["refs"] = refs
+                if (
+                    not all(sha in installed for sha in shas)
+                    and shas != building
+                    and shas != failed
+                    and shas != status["queued"]
+                ):
+                    if status["queued"] is not None:
+                        status["skipped"] += 1
+                        emit_log(
+                            "Skipping the queued build of "
+                            + ", ".join(status["queued"])
+                        )
+                    status["queued"] = shas
+                    cond.notify_all()
+        stop.wait(interval)
+
+    emit_log("Stopping ...")
+    with cond:
+        cond.notify_all()
+    if child and child[0].poll() is None:
+        child[0].terminate()
+        child[0].wait()
+    for t in threads:
+        t.join()
+
+
+def watch_status(socket_path: str) -> dict:
+    """Ask a --watch daemon how it's doing."""
+    with socket.socket(socket.AF_UNIX) as conn:
+        conn.settimeout(FARM_TIMEOUT)
+        conn.connect(socket_path)
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode())
+
+
+def get_distro() -> tuple:
+    """Try to run 'lsb_release -d' and return the output."""
+    return execute_shell(["lsb_release", "-d"])[1]
+
+
+def resolve_revision(repo_dir: str, rev: str, remote=True, git_url=OPENMW_GIT_URL):
+    """
+    Resolve a branch, tag, or SHA to a full commit SHA, or None if that
+    can't be done yet.  With remote set, branches and tags are looked up with
+    'git ls-remote' so nothing has to be fetched to see if they've moved;
+    at git_url, if repo_dir hasn't been cloned yet.
+    """
+    if remote and not looks_like_sha(rev):
+        if "/" in rev:
+            remote_name, name = rev.split("/", 1)
+            patterns = ["refs/heads/" + name]
+        else:
+            remote_name, name = "origin", rev
+            # Annotated tags point at a tag object; "^{}" is the commit.
+            patterns = ["refs/tags/" + name + "^{}", "refs/tags/" + name]
+            patterns.append("refs/heads/" + name)
+        cwd = repo_dir if os.path.isdir(repo_dir) else None
+        if cwd is None:
+            if remote_name != "origin":
+                return None
+            remote_name = git_url
+        exitcode, (out, err) = execute_shell(
+            ["git", "ls-remote", remote_name] + patterns, cwd=cwd
+        )
+        refs = {}
+        if exitcode == 0:
+            for line in out.decode().splitlines():
+                sha, ref = line.split()
+                refs[ref] = sha
+        for ref in patterns:
+            if ref in refs:
+                return refs[ref]
+    if os.path.isdir(repo_dir):
+        exitcode, (out, err) = execute_shell(
+            ["git", "rev-parse", "--verify", "-q", rev + "^{commit}"], cwd=repo_dir
+        )
+        if exitcode == 0:
+            return out.decode().strip()
+    return None
+
+
+def read_manifest(install_prefix: str) -> dict:
+    """Installed OpenMW builds, keyed by their full commit SHA."""
+    try:
+        with open(os.path.join(install_prefix, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(install_prefix: str, manifest: dict) -> None:
+    path = os.path.join(install_prefix, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def installed_openmw(install_prefix: str, sha: str, manifest: dict):
+    """The openmw-<sha> dir a commit is installed in, if it is."""
+    entry = manifest.get(sha)
+    if entry:
+        dirs = [entry["dir"]]
+    elif not os.path.isdir(install_prefix):
+        return None
+    else:
+        # Builds from before there was a manifest.
+        dirs = [
+            d
+            for d in os.listdir(install_prefix)
+            if re.fullmatch(r"openmw-[0-9a-f]{7,40}", d) and sha.startswith(d[7:])
+        ]
+    for d in dirs:
+        if os.path.isfile(os.path.join(install_prefix, d, "bin", "openmw")):
+            return d
+    return None
+
+
+def link_openmw(install_prefix: str, openmw: str) -> None:
+    """Point the 'openmw' symlink at an install."""
+    openmw_link = os.path.join(install_prefix, "openmw")
+    if os.path.islink(openmw_link):
+        if os.readlink(openmw_link) == openmw:
+            return
+        os.remove(openmw_link)
+    os.symlink(openmw, openmw_link)
+
+
+def is_release(rev: str) -> bool:
+    """Branches are always "remote/branch", so anything else that isn't a SHA is a tag."""
+    return "/" not in rev and not looks_like_sha(rev)
+
+
+def file_digest(path: str, mode: int) -> str:
+    # The mode is part of the digest since hardlinks share it.
+    h = hashlib.sha256("{:o}\0".format(stat.S_IMODE(mode)).encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def store_tree(store_dir: str, tree: str, threads=1) -> tuple:
+    """
+    Move every file of an install tree into the content-addressed store, and
+    hardlink it back in place.  Files the store already has a copy of are
+    replaced by a link to that copy.  Return how many files were linked to
+    an existing copy, and how many bytes that freed.
+    """
+    files = []
+    for root, dirs, filenames in os.walk(tree):
+        for name in filenames:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            # More than one link means it's been stored already.
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                files.append((path, st))
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        digests = pool.map(lambda f: file_digest(f[0], f[1].st_mode), files)
+        linked = freed = 0
+        for (path, st), digest in zip(files, digests):
+            blob = os.path.join(store_dir, digest[:2], digest[2:])
+            if os.path.exists(blob):
+                tmp = path + ".store.tmp"
+                os.link(blob, tmp)
+                os.replace(tmp, path)
+                linked += 1
+                freed += st.st_size
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(path, blob)
+    return linked, freed
+
+
+def collect_garbage(install_prefix: str, manifest: dict, keep: int, current: str):
+    """
+    Remove installed OpenMW builds except for the newest keep of them, any
+    built from a release tag, and the current one, then drop whatever the
+    store holds that no remaining install links to.  Return the removed
+    dirs and how many bytes the store freed.
+    """
+    newest = sorted(manifest, key=lambda s: manifest[s]["installed"], reverse=True)
+    removed = []
+    for sha in newest[keep:]:
+        entry = manifest[sha]
+        if is_release(entry["rev"]) or entry["dir"] == current:
+            continue
+        for path in (
+            os.path.join(install_prefix, entry["dir"]),
+            os.path.join(install_prefix, entry["dir"] + DEBUG_DIR_SUFFIX),
+            os.path.join(install_prefix, "logs", entry["dir"]),
+            os.path.join(install_prefix, PGO_DIR, sha),
+        ):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        del manifest[sha]
+        removed.append(entry["dir"])
+
+    freed = 0
+    store_dir = os.path.join(install_prefix, STORE_DIR)
+    for root, dirs, filenames in os.walk(store_dir):
+        for name in filenames:
+            blob = os.path.join(root, name)
+            st = os.lstat(blob)
+            if st.st_nlink == 1:
+                os.remove(blob)
+                freed += st.st_size
+    return removed, freed
+
+
+def is_elf(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(4) == b"\x7fELF"
+
+
+def package_files(install_prefix: str, openmw: str, libs: list) -> list:
+    """
+    List what goes into a package as (path, arcname, rpath) tuples: the whole
+    OpenMW install, plus the shared libraries (and OSG plugins) of each of our
+    own builds of libs, all under <openmw>/lib.  rpath is what ELF files
+    should find those libraries with; None for everything else.
+    """
+    files = []
+
+    def _walk(src, dest):
+        for root, dirs, filenames in os.walk(src):
+            dirs.sort()
+            arcdir = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+            files.append((root, arcdir, None))
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            for name in sorted(filenames) + links:
+                if name == STAMP_FILE:
+                    continue
+                path = os.path.join(root, name)
+                rpath = None
+                if not os.path.islink(path) and is_elf(path):
+                    rel = os.path.relpath(os.path.join(openmw, "lib"), arcdir)
+                    rpath = "$ORIGIN" if rel == "." else "$ORIGIN/" + rel
+                files.append((path, os.path.join(arcdir, name), rpath))
+
+    _walk(os.path.join(install_prefix, openmw), openmw)
+    for lib in libs:
+        lib_dir = os.path.join(install_prefix, lib, "lib")
+        if not os.path.isdir(lib_dir):
+            continue
+        for name in sorted(os.listdir(lib_dir)):
+            path = os.path.join(lib_dir, name)
+            arcname = os.path.join(openmw, "lib", name)
+            if name.startswith("osgPlugins") and os.path.isdir(path):
+                _walk(path, arcname)
+            elif ".so" in name and os.path.islink(path):
+                files.append((path, arcname, None))
+            elif ".so" in name and is_elf(path):
+                files.append((path, arcname, "$ORIGIN"))
+    return files
+
+
+def prepare_elf(
+    path: str, rpath: str, tmp_dir: str, with_debug=False, strip=True
+) -> tuple:
+    """
+    Make a stripped copy of an ELF file that finds its libraries via rpath,
+    and with_debug, split its debug info into a '.debug' file next to it.
+    Not strip, it's only copied, for what's left of debug info that was
+    already moved out of it.  Return the paths of both copies; the original
+    is left as it is.
+    """
+    work_dir = tempfile.mkdtemp(dir=tmp_dir)
+    stripped = os.path.join(work_dir, os.path.basename(path))
+    shutil.copy2(path, stripped)
+    debug = None
+    if with_debug:
+        debug = stripped + ".debug"
+        execute_shell(["objcopy", "--only-keep-debug", stripped, debug])
+    if strip:
+        execute_shell(["strip", "--strip-unneeded", stripped])
+    if with_debug:
+        execute_shell(
+            ["objcopy", "--add-gnu-debuglink=" + debug, stripped], cwd=work_dir
+        )
+    # Only dynamically linked files have an rpath to set.
+    execute_shell(["patchelf", "--set-rpath", rpath, stripped])
+    return stripped, debug
+
+
+@contextlib.contextmanager
+def compressed_tar(path: str, compression: str, threads: int):
+    """
+    Stream a tarball through a multi-threaded compressor.  It's written under
+    a temporary name and only renamed into place once it's complete.
+    """
+    cmd, ext = PKG_COMPRESSORS[compression]
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as out:
+        p = subprocess.Popen(
+            [c.format(threads) for c in cmd], stdin=subprocess.PIPE, stdout=out
+        )
+        try:
+            with tarfile.open(fileobj=p.stdin, mode="w|") as tar:
+                yield tar
+        except BaseException:
+            p.stdin.close()
+            p.wait()
+            os.remove(tmp)
+            raise
+        p.stdin.close()
+        exitcode = p.wait()
+    if exitcode != 0:
+        os.remove(tmp)
+        error_and_die("{0} exited nonzero while writing {1}!".format(cmd[0], path))
+    os.replace(tmp, path)
+
+
+def launcher_script(profiles: list) -> str:
+    """
+    A shell script that runs the program it's named after from the best of
+    the given CPU profiles' builds that this CPU can run.
+    """
+    cases = "".join(
+        "        {0}) has {1} || continue ;;\n".format(p, CPU_PROFILES[p][1])
+        for p in CPU_PROFILES
+        if p in profiles and CPU_PROFILES[p][1]
+    )
+    return (
+        "#!/bin/sh\n"
+        "# Made by build-openmw: run the build of this program that best fits this CPU.\n"
+        'here=$(dirname "$(readlink -f "$0")")\n'
+        'prog=$(basename "$0")\n'
+        "flags=$(grep -m1 '^flags' /proc/cpuinfo 2>/dev/null)\n"
+        'has() {{ for f; do case " $flags " in *" $f "*) ;; *) return 1 ;; esac; done; }}\n'
+        "for profile in {0}; do\n"
+        '    case "$profile" in\n'
+        "{1}"
+        "    esac\n"
+        '    exec "$here/$profile/bin/$prog" "$@"\n'
+        "done\n"
+        'echo "No build of $prog in $here runs on this CPU!" >&2\n'
+        "exit 1\n"
+    ).format(" ".join(p for p in CPU_PROFILES if p in profiles), cases)
+
+
+def make_package(
+    install_prefix: str,
+    openmw: str,
+    libs: list,
+    out_dir: str,
+    compression="zstd",
+    threads=1,
+    with_debug=False,
+    profiles=None,
+    debug_dir=None,
+) -> list:
+    """
+    Write <openmw>.tar.<ext> to out_dir, and with_debug, a matching
+    <openmw>-debug tarball of split debug info, or of debug_dir, if its debug
+    info was moved there when it was installed.  Files are stripped and have
+    their rpaths rewritten one at a time (a few at once, really) on their way
+    into the tarball, so a full copy of the package is never made on disk.
+
+    With profiles, a list of --cpu-profile names, the build of each from
+    <install_prefix>/<profile> goes under <openmw>/<profile>, and each of
+    their programs gets a launcher in <openmw> that picks one to run.
+    """
+    if profiles:
+        files = [(os.path.join(install_prefix, profiles[0], openmw), openmw, None)]
+        for profile in profiles:
+            for path, arcname, rpath in package_files(
+                os.path.join(install_prefix, profile), openmw, libs
+            ):
+                rel = os.path.relpath(arcname, openmw)
+                arcname = os.path.normpath(os.path.join(openmw, profile, rel))
+                files.append((path, arcname, rpath))
+        bin_dir = os.path.join(install_prefix, profiles[0], openmw, "bin")
+        programs = sorted(
+            name
+            for name in os.listdir(bin_dir)
+            if os.access(os.path.join(bin_dir, name), os.X_OK)
+        )
+    else:
+        files = package_files(install_prefix, openmw, libs)
+        programs = []
+    ext = PKG_COMPRESSORS[compression][1]
+    tarballs = [os.path.join(out_dir, openmw + ext)]
+    if with_debug:
+        tarballs.append(os.path.join(out_dir, openmw + "-debug" + ext))
+
+    def _owner(tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = "root"
+        return tarinfo
+
+    with contextlib.ExitStack() as stack:
+        tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(dir=out_dir))
+        tars = [
+            stack.enter_context(compressed_tar(t, compression, threads))
+            for t in tarballs
+        ]
+        pool = stack.enter_context(concurrent.futures.ThreadPoolExecutor(threads))
+
+        def _add(path, arcname, future):
+            if future is None:
+                tars[0].add(path, arcname, recursive=False, filter=_owner)
+                return
+            stripped, debug = future.result()
+            tars[0].add(stripped, arcname, filter=_owner)
+            if debug:
+                tars[1].add(debug, arcname + ".debug", filter=_owner)
+            shutil.rmtree(os.path.dirname(stripped))
+
+        # Keep only a few files' worth of stripped copies around at a time,
+        # while still adding them to the tarball in order.
+        window = collections.deque()
+        for path, arcname, rpath in files:
+            future = None
+            if rpath:
+                future = pool.submit(
+                    prepare_elf,
+                    path,
+                    rpath,
+                    tmp_dir,
+                    with_debug and not debug_dir,
+                    not debug_dir,
+                )
+            window.append((path, arcname, future))
+            while len(window) > threads * 2:
+                _add(*window.popleft())
+        while window:
+            _add(*window.popleft())
+        if debug_dir:
+            tars[1].add(debug_dir, os.path.basename(debug_dir), filter=_owner)
+        script = launcher_script(profiles or []).encode()
+        for name in programs:
+            tarinfo = _owner(tarfile.TarInfo(os.path.join(openmw, name)))
+            tarinfo.size = len(script)
+            tarinfo.mode = 0o755
+            tarinfo.mtime = time.time()
+            tars[0].addfile(tarinfo, io.BytesIO(script))
+    return tarballs
+
+
+def distro_packages(distro: str) -> tuple:
+    """
+    The name of a distro, the packages it needs, and its package manager, or
+    die if it isn't supported.
+    """
+    # TODO: install system OSG as needed..
+    if "void" in distro.lower():
+        return "Void Linux", VOID_PKGS, "xbps"
+    elif "arch" in distro.lower():
+        return "Arch Linux", ARCH_PKGS, "pacman"
+    elif "debian" in distro.lower():
+        return "Debian", DEBIAN_PKGS, "dpkg"
+    elif "devuan" in distro.lower():
+        # Debian packages should just work in this case.
+        return "Devuan", DEBIAN_PKGS, "dpkg"
+    elif "ubuntu" in distro.lower() or "mint" in distro.lower():
+        return "Mint' or 'Ubuntu", UBUNTU_PKGS, "dpkg"
+    elif "fedora" in distro.lower():
+        return "Fedora", FEDORA_PKGS, "rpm"
+    error_and_die(
+        "Your OS is not yet supported!  If you think you know what you are doing, you can use '-S' to continue anyways."
+    )
+
+
+def missing_packages(manager: str, pkgs: list) -> list:
+    """Ask the package manager, once, which of pkgs aren't installed."""
+    if manager == "xbps":
+        # "ii <name>-<version>_<revision> <description>"
+        out = execute_shell(["xbps-query", "-l"])[1][0].decode()
+        installed = {
+            line.split()[1].rsplit("-", 1)[0]
+            for line in out.splitlines()
+            if len(line.split()) > 1
+        }
+    elif manager == "dpkg":
+        # Unknown packages only show up on stderr.
+        out = execute_shell(
+            ["dpkg-query", "-W", "-f=${Package} ${db:Status-Abbrev}\n"] + pkgs
+        )[1][0].decode()
+        installed = {
+            line.split()[0] for line in out.splitlines() if line.split()[1:2] == ["ii"]
+        }
+    elif manager == "rpm":
+        # "package <name> is not installed" is on stdout too, so installed
+        # ones are marked.
+        cmd = ["rpm", "-q", "--qf", "installed %{NAME}\n"] + pkgs
+        out = execute_shell(cmd)[1][0].decode()
+        installed = {
+            line.split()[1]
+            for line in out.splitlines()
+            if line.startswith("installed ") and len(line.split()) == 2
+        }
+    else:
+        out = execute_shell(["pacman", "-Q"] + pkgs)[1][0].decode()
+        installed = {line.split()[0] for line in out.splitlines() if line.strip()}
+    return [p for p in collections.OrderedDict.fromkeys(pkgs) if p not in installed]
+
+
+def packages_key() -> str:
+    """
+    Hash the package lists, the OS release, and when each package database
+    was last changed, so that a stamp with this key says no package could
+    have gone missing since it was written.
+    """
+    db = {}
+    for path in PACKAGE_DBS:
+        try:
+            db[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+    data = {
+        "packages": [ARCH_PKGS, DEBIAN_PKGS, FEDORA_PKGS, UBUNTU_PKGS, VOID_PKGS],
+        "os_release": read_sys_file("/etc/os-release"),
+        "db": db,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def install_packages(distro: str, **kwargs) -> tuple:
+    """
+    Install whichever of the packages the distro needs aren't installed yet,
+    and return the package manager's output, or None if nothing was missing.
+    """
+    quiet = kwargs.pop("quiet", "")
+    verbose = kwargs.pop("verbose", "")
+    log_file = kwargs.pop("log_file", None)
+
+    name, pkgs, manager = distro_packages(distro)
+    emit_log("Distro detected as '{}'".format(name))
+    missing = missing_packages(manager, pkgs)
+    if not missing:
+        emit_log("All needed packages are installed")
+        return None
+    emit_log("Missing packages: " + " ".join(missing))
+    emit_log(
+        "Attempting to install dependency packages, please enter your sudo password as needed...",
+        quiet=quiet,
+    )
+    cmd = {
+        "xbps": ["xbps-install", "--yes"],
+        "pacman": ["pacman", "-sy"],
+        "dpkg": ["apt-get", "install", "-y", "--force-yes"],
+        "rpm": ["dnf", "install", "-y"],
+    }[manager] + missing
+    if os.getuid() > 0:
+        cmd = ["sudo"] + cmd
+    out, err = execute_shell(cmd, verbose=verbose, log_file=log_file)[1]
+    emit_log("Package installation completed")
+    return out, err
+
+
+def parse_argv() -> None:
+    """Set up args and parse them."""
+    parser = argparse.ArgumentParser(description=DESC, prog=PROG)
+    parser.add_argument(
+        "--version", action="version", version=VERSION, help=argparse.SUPPRESS
+    )
+    version_options = parser.add_argument_group(
+        "Versions",
+        "These can be given more than once, and mixed, to build several OpenMW revisions side by side.  The first one is what the 'openmw' symlink points to.",
+    )
+    version_options.add_argument(
+        "-s", "--sha", action="append", dest="revs", help="The git sha1sum to build."
+    )
+    version_options.add_argument(
+        "-t",
+        "--tag",
+        action="append",
+        dest="revs",
+        help="The git release tag to build.",
+    )
+    version_options.add_argument(
+        "-b",
+        "--branch",
+        action="append",
+        dest="revs",
+        type=lambda b: b if "/" in b else "origin/" + b,
+        help="The git branch to build (the tip of.)",
+    )
+    version_options.add_argument("--sdl-version", help="The git tag to build for SDL2")
+    options = parser.add_argument_group("Options")
+    options.add_argument(
+        "--system-bullet",
+        action="store_true",
+        help="Build LibBullet, rather than use the system package.",
+    )
+    options.add_argument(
+        "--build-ffmpeg",
+        action="store_true",
+        help="Build FFMPEG, rather than use the system package.",
+    )
+    options.add_argument(
+        "--build-mygui",
+        action="store_true",
+        help="Build MyGUI, rather than use the system package.",
+    )
+    options.add_argument(
+        "--build-qt5",
+        action="store_true",
+        help="Build Qt5, rather than use the system package.",
+    )
+    options.add_argument(
+        "--build-sdl2",
+        action="store_true",
+        help="Build SDL2, rather than use the system package.",
+    )
+    options.add_argument(
+        "--build-unshield",
+        action="store_true",
+        help="Build libunshield, rather than use the system package.",
+    )
+    options.add_argument(
+        "--force-bullet", action="store_true", help="Force build LibBullet."
+    )
+    options.add_argument(
+        "--force-ffmpeg", action="store_true", help="Force build FFMPEG."
+    )
+    options.add_argument(
+        "--force-mygui", action="store_true", help="Force build MyGUI."
+    )
+    options.add_argument("--force-qt5", action="store_true", help="Force build Qt5.")
+    options.add_argument("--force-sdl2", action="store_true", help="Force build SDL2.")
+    options.add_argument(
+        "--force-openmw", action="store_true", help="Force build OpenMW."
+    )
+    options.add_argument("--force-osg", action="store_true", help="Force build OSG.")
+    options.add_argument(
+        "--force-raknet", action="store_true", help="Force build Raknet."
+    )
+    options.add_argument(
+        "--force-unshield", action="store_true", help="Force build Unshield."
+    )
+    options.add_argument(
+        "--force-all",
+        action="store_true",
+        help="Force build all dependencies and OpenMW.",
+    )
+    options.add_argument(
+        "--system-osg",
+        action="store_true",
+        help="Use the system-provided OSG instead of the OpenMW forked one.",
+    )
+    # TODO: Don't hardcode the OSG branch, use the below flag.
+    # options.add_argument(
+    #     "--openmw-osg-branch",
+    #     action="store_true",
+    #     help="Specify the OpenMW OSG fork branch to build.  Default: "
+    #     + OPENMW_OSG_BRANCH,
+    # )
+    options.add_argument(
+        "--artifact-cache",
+        metavar="DIR",
+        help="Keep built dependencies as tarballs in this directory (which may be shared, over NFS for example) and restore them instead of rebuilding.",
+    )
+    options.add_argument(
+        "--blobless",
+        action="store_true",
+        help="Make blobless clones ('--filter=blob:none'), file contents are only downloaded as they are checked out.",
+    )
+    options.add_argument(
+        "--cpu-profile",
+        choices=list(CPU_PROFILES),
+        help="Build OpenMW, OSG, and Bullet for this kind of CPU ('native' is this one), into <install prefix>/<profile>.  Default: whatever the compiler targets by default, right in the install prefix",
+    )
+    options.add_argument(
+        "--build-root",
+        metavar="DIR",
+        help="Keep cmake build trees in here instead of in each source dir, for instance on a faster disk.  'auto' uses /dev/shm (or /tmp) if it's a tmpfs.  A build that isn't expected to fit, going by the size of earlier ones and free memory, or that fills it up, builds on disk instead.",
+    )
+    options.add_argument(
+        "--clone-depth",
+        metavar="N",
+        type=int,
+        help="Make shallow clones of this depth, and only fetch the pinned branch, tag, or SHA of each repo.",
     )
-    version_options = parser.add_mutually_exclusive_group()
-    version_options.add_argument("-s", "--sha", help="The git sha1sum to build.")
-    version_options.add_argument("-t", "--tag", help="The git release tag to build.")
-    version_options.add_argument(
-        "-b", "--branch", help="The git branch to build (the tip of.)"
+    options.add_argument(
+        "--compiler-cache",
+        choices=("ccache", "sccache"),
+        help="Cache compiler output with ccache or sccache for every library that gets built.",
     )
-    version_options.add_argument("--sdl-version", help="The git tag to build for SDL2")
-    options = parser.add_argument_group("Options")
     options.add_argument(
-        "--system-bullet",
-        action="store_true",
-        help="Build LibBullet, rather than use the system package.",
+        "--compiler-cache-dir",
+        metavar="DIR",
+        help="Where the compiler cache lives.  Default: <install prefix>/cache/<ccache|sccache>",
     )
     options.add_argument(
-        "--build-ffmpeg",
-        action="store_true",
-        help="Build FFMPEG, rather than use the system package.",
+        "--compiler-cache-size",
+        metavar="SIZE",
+        help="Size limit for the compiler cache.  Default: {}".format(
+            COMPILER_CACHE_SIZE
+        ),
     )
     options.add_argument(
-        "--build-mygui",
-        action="store_true",
-        help="Build MyGUI, rather than use the system package.",
+        "--debug-build-type",
+        choices=("Debug", "RelWithDebInfo"),
+        help="The CMAKE_BUILD_TYPE of a '--with-debug' build; RelWithDebInfo is optimized.  Implies '--with-debug'.  Default: Debug",
     )
     options.add_argument(
-        "--build-qt5",
-        action="store_true",
-        help="Build Qt5, rather than use the system package.",
+        "--debug-info",
+        choices=list(DEBUG_INFO),
+        help="How a '--with-debug' build of OpenMW keeps its debug info.  'inline' leaves it all in the programs.  'split' keeps it out of the link ('-gsplit-dwarf', '--gdb-index', and '-gz'), then packs it into a .dwp per program.  'separate' compresses it ('-gz') and moves it to a .debug file per program.  Both of those keep it in <openmw>{0} next to the install, run gdb with '-x <openmw>{0}/gdbinit' to find it.  Implies '--with-debug'.  Default: inline".format(
+            DEBUG_DIR_SUFFIX
+        ),
     )
     options.add_argument(
-        "--build-sdl2",
+        "--dedupe",
         action="store_true",
-        help="Build SDL2, rather than use the system package.",
+        help="Keep one copy of each file shared between installed OpenMW builds, in <install prefix>/{}, and hardlink them into place.".format(
+            STORE_DIR
+        ),
     )
     options.add_argument(
-        "--build-unshield",
+        "--farm",
+        choices=("distcc", "icecc"),
+        help="Hand OSG and OpenMW compiles to other hosts with distcc or icecc.  distcc uses the '--farm-workers', or DISTCC_HOSTS if none are given.",
+    )
+    options.add_argument(
+        "--farm-workers",
+        metavar="HOST[:PORT],...",
+        help="Build farm workers (see '--farm-worker') to hand compiles to with distcc, given jobs according to how many cores each has free.  Default port: {}".format(
+            FARM_PORT
+        ),
+    )
+    options.add_argument(
+        "--farm-worker",
         action="store_true",
-        help="Build libunshield, rather than use the system package.",
+        help="Don't build anything, serve as a build farm worker for other hosts instead.  Runs distccd with '-j' jobs.",
     )
     options.add_argument(
-        "--force-bullet", action="store_true", help="Force build LibBullet."
+        "--farm-port",
+        metavar="PORT",
+        type=int,
+        help="The port a build farm worker listens on; distccd uses the next one.  Default: {}".format(
+            FARM_PORT
+        ),
     )
     options.add_argument(
-        "--force-ffmpeg", action="store_true", help="Force build FFMPEG."
+        "--farm-allow",
+        metavar="CIDR",
+        help="Hosts a build farm worker takes compiles from.  Default: 127.0.0.1",
     )
     options.add_argument(
-        "--force-mygui", action="store_true", help="Force build MyGUI."
+        "--fast-compile",
+        action="store_true",
+        help="Trade runtime speed for build speed: unity builds for OSG and OpenMW, precompiled headers for OpenMW, no LTO, and mold, lld, or gold for linking if one is installed.",
     )
-    options.add_argument("--force-qt5", action="store_true", help="Force build Qt5.")
-    options.add_argument("--force-sdl2", action="store_true", help="Force build SDL2.")
     options.add_argument(
-        "--force-openmw", action="store_true", help="Force build OpenMW."
+        "--fetch-jobs",
+        metavar="N",
+        type=int,
+        help="How many repos to clone or fetch at the same time.  Default: {}".format(
+            FETCH_JOBS
+        ),
     )
-    options.add_argument("--force-osg", action="store_true", help="Force build OSG.")
     options.add_argument(
-        "--force-raknet", action="store_true", help="Force build Raknet."
+        "--fetch-only",
+        action="store_true",
+        help="Clone or update every needed source repo, then exit without building.",
     )
     options.add_argument(
-        "--force-unshield", action="store_true", help="Force build Unshield."
+        "--offline",
+        action="store_true",
+        help="Don't touch the network; build only from sources that have already been fetched.",
     )
     options.add_argument(
-        "--force-all",
+        "--gc",
         action="store_true",
-        help="Force build all dependencies and OpenMW.",
+        help="Remove installed OpenMW builds other than the newest ones (see '--keep'), those built from a release tag, and the current one.",
     )
     options.add_argument(
-        "--system-osg",
+        "--keep",
+        metavar="N",
+        type=int,
+        help="How many of the newest OpenMW builds '--gc' keeps.  Default: {}".format(
+            GC_KEEP
+        ),
+    )
+    options.add_argument(
+        "--generator",
+        choices=("make", "ninja"),
+        help="The build tool CMake should generate for.  Falls back to make when ninja isn't installed.  Default: make",
+    )
+    options.add_argument(
+        "--git-mirror-dir",
+        metavar="DIR",
+        help="Keep bare mirrors of every repo here and have clones borrow objects from them, so several prefixes on one host share a download.",
+    )
+    options.add_argument(
+        "--incremental",
         action="store_true",
-        help="Use the system-provided OSG instead of the OpenMW forked one.",
+        help="Keep build trees between runs and only re-run cmake or configure when their arguments or environment change.",
     )
-    # TODO: Don't hardcode the OSG branch, use the below flag.
-    # options.add_argument(
-    #     "--openmw-osg-branch",
-    #     action="store_true",
-    #     help="Specify the OpenMW OSG fork branch to build.  Default: "
-    #     + OPENMW_OSG_BRANCH,
-    # )
     options.add_argument(
         "--install-prefix",
         help="Set the install prefix. Default: {}".format(INSTALL_PREFIX),
@@ -455,10 +3093,20 @@ def parse_argv() -> None:
     options.add_argument(
         "-j",
         "--jobs",
+        type=int,
         help="How many cores to use with make.  Default: {}".format(CPUS),
     )
     options.add_argument(
-        "-p", "--make-pkg", action="store_true", help="Make a portable package."
+        "--parallel-builds",
+        metavar="N",
+        type=int,
+        help="How many libraries may build at the same time, sharing the '-j' budget.  Default: as many as are ready",
+    )
+    options.add_argument(
+        "-p",
+        "--make-pkg",
+        action="store_true",
+        help="Make a portable package of OpenMW and the libraries built for it, in the '--out' dir.",
     )
     options.add_argument(
         "-N",
@@ -475,6 +3123,41 @@ def parse_argv() -> None:
     options.add_argument(
         "-P", "--patch", help="Path to a patch file that should be applied."
     )
+    options.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print what would be fetched, built, or restored from the artifact cache, and why, without doing any of it.",
+    )
+    options.add_argument(
+        "--pgo",
+        metavar="COMMAND",
+        help="Build OpenMW with profile-guided optimization, using this shell command to train it.  OPENMW_BIN is set to the OpenMW binary to run.  Profiles are kept per commit in <install prefix>/pgo.",
+    )
+    options.add_argument(
+        "--pgo-bolt",
+        action="store_true",
+        help="After a PGO build, also optimize the OpenMW binary with BOLT (llvm-bolt), trained by the same command.",
+    )
+    options.add_argument(
+        "--pkg-cpu-profiles",
+        metavar="PROFILES",
+        help="Bundle the builds of OpenMW from these comma-separated '--cpu-profile's into one package, with launchers that pick the best one for the CPU they run on.  Each must have been built already.",
+    )
+    options.add_argument(
+        "--pkg-compression",
+        choices=sorted(PKG_COMPRESSORS),
+        help="How to compress packages.  Default: zstd if it's installed, otherwise xz",
+    )
+    options.add_argument(
+        "--recipes",
+        metavar="FILE",
+        help="A JSON (or with Python 3.11+, TOML) file of recipes that change or add to the libraries this script builds.",
+    )
+    options.add_argument(
+        "--report",
+        action="store_true",
+        help="Print a summary of how long each build phase took, slowest first.  A JSON report is always written to <install prefix>/logs/reports.",
+    )
     options.add_argument(
         "-S",
         "--skip-install-pkgs",
@@ -487,6 +3170,29 @@ def parse_argv() -> None:
     options.add_argument(
         "-U", "--update", action="store_true", help="Try to update this script."
     )
+    options.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, build whenever a requested revision moves upstream.",
+    )
+    options.add_argument(
+        "--watch-interval",
+        metavar="SECONDS",
+        type=int,
+        help="How often '--watch' checks upstream.  Default: {}".format(WATCH_INTERVAL),
+    )
+    options.add_argument(
+        "--watch-socket",
+        metavar="PATH",
+        help="Where '--watch' answers status requests.  Default: <install prefix>/{}".format(
+            WATCH_SOCKET
+        ),
+    )
+    options.add_argument(
+        "--watch-status",
+        action="store_true",
+        help="Print the status of a running '--watch' daemon and exit.",
+    )
     options.add_argument(
         "--with-debug", action="store_true", help="Build OpenMW with debug symbols."
     )
@@ -515,6 +3221,14 @@ def parse_argv() -> None:
         action="store_true",
         help="Do not build the install wizard. (Default: false)",
     )
+    options.add_argument(
+        "--unity-batch-size",
+        metavar="N",
+        type=int,
+        help="How many sources go into one unity build file with '--fast-compile'.  Default: {}".format(
+            UNITY_BATCH_SIZE
+        ),
+    )
     options.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose output."
     )
@@ -526,8 +3240,27 @@ def main() -> None:
     # TODO: option to skip a given dependency?
     logging.basicConfig(format=LOGFMT, level=logging.INFO, stream=sys.stdout)
     start = datetime.datetime.now()
+    artifact_cache = None
+    blobless = False
+    clone_depth = None
+    compiler_cache = None
+    compiler_cache_dir = None
+    compiler_cache_size = COMPILER_CACHE_SIZE
     cpus = CPUS
+    debug_build_type = "Debug"
+    debug_info = "inline"
+    dedupe = False
     distro = None
+    farm = None
+    farm_workers = []
+    fast_compile = False
+    cpu_profile = None
+    pkg_cpu_profiles = []
+    pgo = None
+    pgo_bolt = False
+    plan = False
+    recipes_file = None
+    build_root = None
     system_bullet = False
     build_ffmpeg = False
     build_mygui = False
@@ -542,18 +3275,28 @@ def main() -> None:
     force_openmw = False
     force_osg = False
     force_unshield = False
+    fetch_jobs = FETCH_JOBS
+    fetch_only = False
+    gc = False
+    gc_keep = GC_KEEP
+    offline = False
+    generator = None
+    git_mirror = None
+    incremental = False
     install_prefix = INSTALL_PREFIX
     system_osg = False
     parsed = parse_argv()
     out_dir = OUT_DIR
+    make_pkg = False
+    parallel_builds = None
     patch = None
+    pkg_compression = "zstd" if shutil.which("zstd") else "xz"
     pull = True
+    show_report = False
     skip_install_pkgs = False
     src_dir = SRC_DIR
     verbose = False
-    sha = None
-    tag = None
-    branch = "master"
+    revs = ["origin/master"]
     with_debug = False
     with_essimporter = False
     without_cs = False
@@ -614,12 +3357,93 @@ def main() -> None:
     if parsed.force_unshield:
         force_unshield = True
         emit_log("Forcing build of Unshield")
+    if parsed.artifact_cache:
+        artifact_cache = os.path.abspath(parsed.artifact_cache)
+        emit_log("Using the artifact cache: " + artifact_cache)
+    if parsed.blobless:
+        blobless = True
+        emit_log("Blobless clones will be made")
+    if parsed.clone_depth:
+        clone_depth = parsed.clone_depth
+        emit_log("Shallow clones of depth {} will be made".format(clone_depth))
+    if parsed.compiler_cache:
+        compiler_cache = parsed.compiler_cache
+        if not shutil.which(compiler_cache):
+            error_and_die("'{}' was not found!".format(compiler_cache))
+        emit_log("Compiler output will be cached with " + compiler_cache)
+    if parsed.compiler_cache_dir:
+        compiler_cache_dir = os.path.abspath(parsed.compiler_cache_dir)
+        emit_log("Compiler cache directory set to: " + compiler_cache_dir)
+    if parsed.compiler_cache_size:
+        compiler_cache_size = parsed.compiler_cache_size
+        emit_log("Compiler cache size limit set to: " + compiler_cache_size)
+    if parsed.dedupe:
+        dedupe = True
+        emit_log("Files shared between OpenMW builds will be deduplicated")
+    if parsed.farm:
+        farm = parsed.farm
+        if not shutil.which(farm):
+            error_and_die("'{}' was not found!".format(farm))
+        if compiler_cache == "sccache":
+            error_and_die(
+                "'--farm' doesn't work with sccache, which has a distributed mode of its own!"
+            )
+        if farm == "distcc":
+            if parsed.farm_workers:
+                farm_workers = parsed.farm_workers.split(",")
+            elif not os.getenv("DISTCC_HOSTS"):
+                error_and_die("distcc needs '--farm-workers' or DISTCC_HOSTS!")
+        emit_log("Compiles will be handed to other hosts with " + farm)
+    if parsed.fast_compile:
+        fast_compile = True
+        emit_log("OSG and OpenMW will be built for build speed, not runtime speed")
+    if parsed.fetch_jobs:
+        fetch_jobs = parsed.fetch_jobs
+        emit_log("Up to {} repos will be fetched at once".format(fetch_jobs))
+    if parsed.fetch_only and parsed.offline:
+        error_and_die("'--fetch-only' and '--offline' don't go together!")
+    if parsed.fetch_only:
+        fetch_only = True
+        emit_log("Sources will be fetched but nothing will be built")
+    if parsed.offline:
+        offline = True
+        pull = False
+        emit_log("Offline mode, only already fetched sources will be used")
+    if parsed.gc:
+        gc = True
+    if parsed.keep is not None:
+        gc_keep = parsed.keep
+    if gc:
+        emit_log(
+            "Old OpenMW builds will be removed, keeping the last {}".format(gc_keep)
+        )
+    if parsed.generator == "ninja":
+        if shutil.which("ninja"):
+            generator = "ninja"
+            emit_log("CMake builds will use ninja")
+        else:
+            generator = "make"
+            emit_log("ninja was not found, falling back to make", level=logging.WARN)
+    elif parsed.generator == "make":
+        generator = "make"
+    if parsed.git_mirror_dir:
+        git_mirror = os.path.abspath(parsed.git_mirror_dir)
+        emit_log("Using git mirrors in: " + git_mirror)
+    if parsed.incremental:
+        incremental = True
+        emit_log("Build trees will be kept for incremental rebuilds")
     if parsed.install_prefix:
         install_prefix = parsed.install_prefix
         emit_log("Using the install prefix: " + install_prefix)
     if parsed.jobs:
         cpus = parsed.jobs
         emit_log("'-j{}' will be used with make".format(cpus))
+    if parsed.make_pkg:
+        make_pkg = True
+        emit_log("A package will be made")
+    if parsed.parallel_builds:
+        parallel_builds = parsed.parallel_builds
+        emit_log("At most {} libraries will build at once".format(parallel_builds))
     if parsed.no_pull:
         pull = False
         emit_log("git fetch will not be ran")
@@ -632,6 +3456,50 @@ def main() -> None:
             emit_log("Will attempt to use this patch: " + patch)
         else:
             error_and_die("The supplied patch isn't a file!")
+    if parsed.pgo:
+        if parsed.fast_compile:
+            error_and_die("'--pgo' and '--fast-compile' don't go together!")
+        pgo = parsed.pgo
+        emit_log("OpenMW will be built with PGO, trained by: " + pgo)
+    if parsed.pgo_bolt:
+        if not pgo:
+            error_and_die("'--pgo-bolt' needs '--pgo'!")
+        pgo_bolt = True
+        emit_log("OpenMW will be optimized with BOLT")
+    if parsed.pkg_compression:
+        pkg_compression = parsed.pkg_compression
+    if parsed.plan:
+        plan = True
+    if parsed.build_root == "auto":
+        build_root = auto_build_root()
+        if build_root:
+            emit_log("Build trees will be kept in memory, in: " + build_root)
+        else:
+            emit_log(
+                "No tmpfs was found for '--build-root auto', building on disk",
+                level=logging.WARN,
+            )
+    elif parsed.build_root:
+        build_root = os.path.abspath(parsed.build_root)
+        ensure_dir(build_root, create=not plan)
+        emit_log("Build trees will be kept in: " + build_root)
+    if parsed.recipes:
+        recipes_file = os.path.abspath(parsed.recipes)
+        emit_log("Using recipes from: " + recipes_file)
+    if parsed.cpu_profile:
+        cpu_profile = parsed.cpu_profile
+        if cpu_profile != "native" and platform.machine() not in ("x86_64", "AMD64"):
+            error_and_die("'--cpu-profile {}' is only for x86-64!".format(cpu_profile))
+        emit_log("Building for the {} CPU profile".format(cpu_profile))
+    if parsed.pkg_cpu_profiles:
+        if not parsed.make_pkg:
+            error_and_die("'--pkg-cpu-profiles' needs '--make-pkg'!")
+        pkg_cpu_profiles = parsed.pkg_cpu_profiles.split(",")
+        for profile in pkg_cpu_profiles:
+            if profile not in CPU_PROFILES or profile == "native":
+                error_and_die("Can't bundle the CPU profile: " + profile)
+    if parsed.report:
+        show_report = True
     if parsed.skip_install_pkgs:
         skip_install_pkgs = parsed.skip_install_pkgs
         emit_log("Package installs will be skipped")
@@ -648,6 +3516,18 @@ def main() -> None:
         emit_log("Verbose output enabled")
     if parsed.with_debug:
         with_debug = True
+    if parsed.debug_build_type:
+        with_debug = True
+        debug_build_type = parsed.debug_build_type
+    if parsed.debug_info:
+        with_debug = True
+        debug_info = parsed.debug_info
+    if with_debug:
+        emit_log(
+            "OpenMW will be a {0} build, with {1} debug info".format(
+                debug_build_type, debug_info
+            )
+        )
     if parsed.with_essimporter:
         with_essimporter = True
     if parsed.without_cs:
@@ -659,245 +3539,182 @@ def main() -> None:
     if parsed.without_wizard:
         without_wizard = True
 
+    unity_batch_size = parsed.unity_batch_size or UNITY_BATCH_SIZE
+
+    if parsed.farm_worker:
+        if not shutil.which("distccd"):
+            error_and_die("'distccd' was not found!")
+        farm_worker(
+            parsed.farm_port or FARM_PORT,
+            parsed.farm_allow or "127.0.0.1",
+            parsed.jobs or available_cpus(),
+        )
+        return
+
     if parsed.sdl_version:
         sdl_version = parsed.sdl_version
         emit_log("Building SDL version: " + patch)
 
-    if parsed.branch:
-        branch = rev = parsed.branch
-        if "/" not in branch:
-            branch = rev = "origin/" + parsed.branch
-        emit_log("Branch selected: " + branch)
-    elif parsed.sha:
-        sha = rev = parsed.sha
-        emit_log("SHA selected: " + sha)
-    elif parsed.tag:
-        tag = rev = parsed.tag
-        emit_log("Tag selected: " + tag)
-    else:
-        rev = "origin/" + branch
+    if parsed.revs:
+        revs = list(collections.OrderedDict.fromkeys(parsed.revs))
+        for rev in revs:
+            emit_log("Revision selected: " + rev)
 
-    try:
-        out, err = get_distro()
-        if err:
-            error_and_die(err.decode())
-    except FileNotFoundError:
-        if skip_install_pkgs:
-            pass
-        else:
+    src_dir = os.path.join(install_prefix, "src")
+    base_prefix = install_prefix
+    if cpu_profile:
+        # Sources are shared, but everything built for a profile is kept
+        # apart, so no two profiles' libraries are ever mixed.
+        install_prefix = os.path.join(install_prefix, cpu_profile)
+    # This is a serious edge case, but let's
+    # show a sane error when /opt doesn't exist.  '--plan' only looks.
+    ensure_dir(os.path.join("/", "opt"), create=not plan)
+    ensure_dir(base_prefix, create=not plan)
+    if cpu_profile:
+        ensure_dir(install_prefix, create=not plan)
+    ensure_dir(src_dir, create=not plan)
+
+    watch_socket = parsed.watch_socket or os.path.join(install_prefix, WATCH_SOCKET)
+    if parsed.watch_status:
+        try:
+            print(json.dumps(watch_status(watch_socket), indent=2, sort_keys=True))
+        except OSError as e:
             error_and_die(
-                "Unable to determine your distro to install dependencies!  Try again and use '-S' if you know what you are doing."
+                "No '--watch' daemon answered on {0}: {1}".format(watch_socket, e)
             )
-    else:
-        distro = out.decode().split(":")[1].strip()
+        return
+    if parsed.watch:
+        if parsed.fetch_only or parsed.offline:
+            error_and_die("'--watch' can't be used with '--fetch-only' or '--offline'!")
+        watch(
+            sys.argv[1:],
+            revs,
+            os.path.join(src_dir, "openmw"),
+            install_prefix,
+            interval=parsed.watch_interval or WATCH_INTERVAL,
+            socket_path=watch_socket,
+        )
+        return
 
-    if not skip_install_pkgs:
-        out, err = install_packages(distro, verbose=verbose)
-        if err:
-            # Isn't always necessarily exit-worthy
-            emit_log("Stderr received: " + err.decode())
+    if artifact_cache:
+        ensure_dir(artifact_cache, create=not plan)
+    if git_mirror:
+        ensure_dir(git_mirror, create=not plan)
+    if make_pkg:
+        tools = ["patchelf", "strip", PKG_COMPRESSORS[pkg_compression][0][0]]
+        if with_debug:
+            tools.append("objcopy")
+        missing = [t for t in tools if not shutil.which(t)]
+        if missing:
+            error_and_die("Making a package needs: " + ", ".join(missing))
+        ensure_dir(out_dir, create=not plan)
+    clang = "clang" in compiler_version()
+    if pgo:
+        tools = ["llvm-profdata"] if clang else []
+        if pgo_bolt:
+            tools.append("llvm-bolt")
+        missing = [t for t in tools if not shutil.which(t)]
+        if missing:
+            error_and_die("PGO builds need: " + ", ".join(missing))
+    dwp = None
+    if with_debug and debug_info == "split":
+        # GNU dwp can't read DWARF 5, which newer compilers write by default.
+        dwp = next((t for t in ("llvm-dwp", "dwp") if shutil.which(t)), None)
+        if not dwp:
+            error_and_die("Split debug info needs llvm-dwp or dwp to pack it!")
+        if not shutil.which("objcopy"):
+            error_and_die("Split debug info needs objcopy to compress it!")
+    elif with_debug and debug_info == "separate":
+        missing = [t for t in ("objcopy", "readelf") if not shutil.which(t)]
+        if missing:
+            error_and_die("Separate debug info needs: " + ", ".join(missing))
 
-    src_dir = os.path.join(install_prefix, "src")
-    # This is a serious edge case, but let's
-    # show a sane error when /opt doesn't exist.
-    ensure_dir(os.path.join("/", "opt"))
-    ensure_dir(install_prefix)
-    ensure_dir(src_dir)
-
-    if build_ffmpeg or force_ffmpeg:
-        # FFMPEG
-        build_library(
-            "ffmpeg",
-            check_file=os.path.join(install_prefix, "ffmpeg", "bin", "ffmpeg"),
-            cmake=False,
-            cpus=cpus,
-            force=force_ffmpeg,
-            git_url="https://github.com/FFmpeg/FFmpeg.git",
-            install_prefix=install_prefix,
-            src_dir=src_dir,
-            verbose=verbose,
-            version=FFMPEG_VERSION,
-        )
+    # Nothing below depends on anything else except OpenMW, which needs it
+    # all; these are collected into a graph and built side by side.
+    jobs = {}
+    cpu_args = []
+    if cpu_profile:
+        flags = CPU_PROFILES[cpu_profile][0]
+        cpu_args = ["-DCMAKE_C_FLAGS=" + flags, "-DCMAKE_CXX_FLAGS=" + flags]
 
-    if not system_osg:
-        # OSG-OPENMW
-
-        build_library(
-            "osg-openmw",
-            check_file=os.path.join(install_prefix, "osg-openmw", "lib", "libosg.so"),
-            cmake_args=[
-                "-DBUILD_OSG_PLUGINS_BY_DEFAULT=0",
-                "-DBUILD_OSG_PLUGIN_OSG=1",
-                "-DBUILD_OSG_PLUGIN_DDS=1",
-                "-DBUILD_OSG_PLUGIN_TGA=1",
-                "-DBUILD_OSG_PLUGIN_BMP=1",
-                "-DBUILD_OSG_PLUGIN_JPEG=1",
-                "-DBUILD_OSG_PLUGIN_PNG=1",
-                "-DBUILD_OSG_DEPRECATED_SERIALIZERS=0",
-                "-DBUILD_OSG_EXAMPLES=0",
-            ],
-            cpus=cpus,
-            force=force_osg,
-            git_url="https://github.com/OpenMW/osg.git",
+    def add_job(name, deps=(), weight=1, **kwargs):
+        kwargs.setdefault("artifact_cache", artifact_cache)
+        kwargs.setdefault("build_root", build_root)
+        kwargs.update(
+            blobless=blobless,
+            fetch=False,
+            clone_depth=clone_depth,
+            compiler_cache=compiler_cache,
+            generator=generator,
+            git_mirror=git_mirror,
+            incremental=incremental,
             install_prefix=install_prefix,
             src_dir=src_dir,
             verbose=verbose,
         )
+        jobs[name] = {"deps": list(deps), "weight": weight, "kwargs": kwargs}
 
-    # BULLET
-    if not system_bullet or force_bullet:
-        build_library(
-            "bullet",
-            check_file=os.path.join(
-                install_prefix, "bullet", "lib", "libLinearMath.so"
-            ),
-            cmake_args=[
-                "-DINSTALL_LIBS=on",
-                "-DBUILD_BULLET3=off",
-                "-DBUILD_CPU_DEMOS=off",
-                "-DBUILD_UNIT_TESTS=off",
-                "-DBUILD_BULLET2_DEMOS=off",
-                "-DBUILD_EXTRAS=off",
-                "-DBUILD_GIMPACTUTILS_EXTRA=off",
-                "-DBUILD_HACD_EXTRA=off",
-                "-DBUILD_INVERSE_DYNAMIC_EXTRA=off",
-                "-DBUILD_OBJ2SDF_EXTRA=off",
-                "-DBUILD_OPENGL3_DEMOS=off",
-                "-DBUILD_BULLET_ROBOTICS_EXTRA=off",
-                "-DBUILD_BULLET_ROBOTICS_GUI_EXTRA=off",
-                "-DBUILD_SHARED_LIBS=on",
-                "-DBULLET2_MULTITHREADING=on",
-                "-DUSE_DOUBLE_PRECISION=on",
-                "-DCMAKE_BUILD_TYPE=Release",
-            ],
-            cpus=cpus,
-            force=force_bullet,
-            git_url="https://github.com/bulletphysics/bullet3.git",
-            install_prefix=install_prefix,
-            src_dir=src_dir,
-            verbose=verbose,
-            version=BULLET_VERSION,
+    recipes = [dict(r) for r in RECIPES]
+    for recipe in recipes:
+        if recipe["name"] == "sdl2":
+            recipe["rev"] = sdl_version
+    if recipes_file:
+        recipes = load_recipes(recipes_file, recipes)
+    wanted = {
+        "ffmpeg": build_ffmpeg or force_ffmpeg,
+        "osg-openmw": not system_osg,
+        "bullet": not system_bullet or force_bullet,
+        "unshield": build_unshield or force_unshield,
+        "mygui": build_mygui or force_mygui,
+        "qt5": build_qt5,
+        "sdl2": build_sdl2,
+    }
+    forced = {
+        "ffmpeg": force_ffmpeg,
+        "osg-openmw": force_osg,
+        "bullet": force_bullet,
+        "unshield": force_unshield,
+        "mygui": force_mygui,
+        "qt5": force_qt5,
+        "sdl2": force_sdl2,
+    }
+    recipes = [r for r in recipes if r.get("enabled", wanted.get(r["name"], True))]
+    for recipe in recipe_order(recipes):
+        name = recipe["name"]
+        args = list(recipe.get("args", []))
+        deps_of = [d for d in recipe.get("deps", []) if d in jobs]
+        kwargs = dict(
+            check_file=os.path.join(install_prefix, name, recipe["check_file"]),
+            force=forced.get(name, False),
+            git_url=recipe["url"],
+            version=recipe.get("rev", RECIPE_DEFAULTS["rev"]),
         )
-
-    # UNSHIELD
-    if build_unshield or force_unshield:
-        build_library(
-            "unshield",
-            check_file=os.path.join(install_prefix, "unshield", "bin", "unshield"),
-            cpus=cpus,
-            force=force_unshield,
-            git_url="https://github.com/twogood/unshield.git",
-            install_prefix=install_prefix,
-            src_dir=src_dir,
-            verbose=verbose,
-            version=UNSHIELD_VERSION,
-        )
-
-    # MYGUI
-    if build_mygui or force_mygui:
-        build_library(
-            "mygui",
-            check_file=os.path.join(
-                install_prefix,
-                "mygui",
-                "include",
-                "MYGUI",
-                "MyGUI.h",
-            ),
-            cmake_args=[
-                "-DMYGUI_BUILD_TOOLS=OFF",
-                "-DMYGUI_RENDERSYSTEM=1",
-                "-DMYGUI_BUILD_DEMOS=OFF",
-                "-DMYGUI_BUILD_PLUGINS=OFF",
-                "-DMYGUI_BUILD_TEST_APP=OFF",
-                "-DMYGUI_BUILD_TOOLS=OFF",
-                "-DMYGUI_BUILD_UNITTESTS=OFF",
-            ],
-            cpus=cpus,
-            force=force_mygui,
-            git_url="https://github.com/MyGUI/mygui.git",
-            install_prefix=install_prefix,
-            src_dir=src_dir,
-            verbose=verbose,
-            version=MYGUI_VERSION,
-        )
-
-    # Qt5 (base)
-    if build_qt5:
-        build_library(
-            "qt5",
-            check_file=os.path.join(install_prefix, "qt5", "bin", "qmake"),
-            cmake=False,
-            cpus=cpus,
-            force=force_qt5,
-            git_url="https://github.com/qt/qtbase.git",
-            install_prefix=install_prefix,
-            src_dir=src_dir,
-            verbose=verbose,
-            version=QT_VERSION,
-        )
-
-    # SDL2
-    if build_sdl2:
-        build_library(
-            "sdl2",
-            check_file=os.path.join(install_prefix, "sdl2", "bin", "sdl2-config"),
-            cmake=False,
-            cpus=cpus,
-            force=force_sdl2,
-            git_url="https://github.com/libsdl-org/SDL.git",
-            install_prefix=install_prefix,
-            src_dir=src_dir,
-            verbose=verbose,
-            version=sdl_version,
+        if deps_of:
+            kwargs["env"] = dict(
+                os.environ, CMAKE_PREFIX_PATH=prefix_path(install_prefix, deps_of)
+            )
+        if recipe.get("build", "cmake") == "cmake":
+            if recipe.get("cpu_profile"):
+                args += cpu_args
+            if recipe.get("fast_compile") and fast_compile:
+                args += fast_compile_args(unity_batch_size)
+            kwargs["cmake_args"] = args
+        else:
+            kwargs.update(cmake=False, configure_args=args)
+        add_job(
+            name,
+            deps=deps_of,
+            weight=recipe.get("weight", RECIPE_DEFAULTS["weight"]),
+            **kwargs
         )
 
-    # OPENMW
-    openmw_sha = get_repo_sha(src_dir, rev=rev, pull=pull, verbose=verbose)
-    if openmw_sha:
-        openmw = "openmw-{}".format(openmw_sha)
-    else:
-        # There's no sha yet since the source hasn't been cloned.
-        openmw = "openmw"
-
     build_env = {"PATH": os.environ["PATH"]}
-
-    if system_osg:
-        prefix_path = ""
-    else:
-        prefix_path = "{0}/osg-openmw"
-
-    if not system_bullet or force_bullet:
-        prefix_path += ":{0}/bullet"
-    if not build_ffmpeg or force_ffmpeg:
-        prefix_path += ":{0}/ffmpeg"
-        prefix_path += ":{0}/mygui"
-    if build_qt5 or force_qt5:
-        prefix_path += ":{0}/qt5"
-    if build_sdl2 or force_sdl2:
-        prefix_path += ":{0}/sdl2"
-    if build_unshield or force_unshield:
-        prefix_path += ":{0}/unshield"
-
-    build_env["CMAKE_PREFIX_PATH"] = prefix_path.format(install_prefix)
-
-    distro = None
-    try:
-        out, err = get_distro()
-        if err:
-            error_and_die(err.decode())
-        distro = out.decode().split(":")[1].strip()
-    except FileNotFoundError:
-        if skip_install_pkgs:
-            pass
-        else:
-            error_and_die(
-                "Unable to determine your distro to install dependencies!  Try again and use '-S' if you know what you are doing."
-            )
+    # OpenMW is built against all of them.
+    build_env["CMAKE_PREFIX_PATH"] = prefix_path(install_prefix, jobs)
 
     build_type = "Release"
     if with_debug:
-        build_type = "Debug"
+        build_type = debug_build_type
 
     build_args = ["-DCMAKE_BUILD_TYPE=" + build_type, "-DDESIRED_QT_VERSION=5"]
 
@@ -921,40 +3738,672 @@ def main() -> None:
         emit_log("NOT building the openmw-wizard executable ...")
         build_args.append("-DBUILD_WIZARD=no")
 
+    build_args += cpu_args
+
+    gdb_index = False
     if with_debug:
+        gdb_linker = []
+        if debug_info == "split":
+            gdb_linker = linker_args(GDB_INDEX_LINKERS, flag="--gdb-index")
+        gdb_index = bool(gdb_linker)
+        if debug_info == "split" and not gdb_linker:
+            emit_log(
+                "None of {} are installed and can write a .gdb_index, gdb will index OpenMW each time it loads it".format(
+                    ", ".join(linker for linker, linker_type in GDB_INDEX_LINKERS)
+                ),
+                level=logging.WARN,
+            )
+        elif not fast_compile:
+            # With '--fast-compile' it's linked with one of them already.
+            build_args += gdb_linker
+        build_args += debug_info_args(debug_info, gdb_index=gdb_index)
+
+    if with_debug or fast_compile:
         build_args.append("-DOPENMW_LTO_BUILD=off")
     else:
         build_args.append("-DOPENMW_LTO_BUILD=on")
 
+    if fast_compile:
+        # OpenMW's own unity build option also leaves out the sources that
+        # can't be combined.
+        build_args += [
+            "-DOPENMW_UNITY_BUILD=on",
+            "-DPRECOMPILED_HEADERS=on",
+        ] + fast_compile_args(
+            unity_batch_size, linker_flag="--gdb-index" if gdb_index else None
+        )
+
     if not system_osg:
         build_args.append(
             "-DOSG_DIR=" + os.path.join(install_prefix, "osg-openmw"),
         )
 
-    build_library(
-        openmw,
-        check_file=os.path.join(install_prefix, openmw, "bin", "openmw"),
-        cmake_args=build_args,
-        clone_dest="openmw",
-        cpus=cpus,
+    # Work out which OpenMW commits are wanted once, up front, and stop right
+    # here if they're already installed; this is the path that runs most often.
+    openmw_src = os.path.join(src_dir, "openmw")
+    openmw_shas = [resolve_revision(openmw_src, rev, remote=pull) for rev in revs]
+    manifest = read_manifest(install_prefix)
+    deps = list(jobs)
+
+    def _stamps(commits=None):
+        # Jobs are added after the jobs they depend on, so their stamps are
+        # always there to go into a dependent's stamp.
+        stamps = {}
+        for name, job in jobs.items():
+            kwargs = job["kwargs"]
+            lib_src = os.path.join(src_dir, name)
+            commit = (commits or {}).get(name)
+            if commit:
+                pass
+            elif os.path.isdir(lib_src):
+                commit = resolve_revision(
+                    lib_src,
+                    kwargs.get("version", "master"),
+                    remote=False,
+                )
+            else:
+                # Restored from the artifact cache without ever being
+                # cloned; it's still the commit it was installed from.
+                stored = read_stamp(os.path.join(install_prefix, name, STAMP_FILE))
+                commit = stored.get("commit") if stored else None
+            stamps[name] = library_stamp(
+                name, commit, kwargs, {d: stamps[d] for d in job["deps"] if d in stamps}
+            )
+        return stamps
+
+    def _cached_commit(name, kwargs):
+        """The commit a library would build, if the artifact cache has it."""
+        lib_src = os.path.join(src_dir, name)
+        version = kwargs.get("version", "master")
+        if os.path.isdir(lib_src):
+            commit = resolve_revision(lib_src, version, remote=False)
+        elif looks_like_sha(version) and len(version) == 40:
+            commit = version
+        elif offline:
+            commit = None
+        else:
+            commit = resolve_revision(lib_src, version, git_url=kwargs["git_url"])
+        if commit and os.path.isfile(
+            artifact_file(
+                kwargs["artifact_cache"],
+                name,
+                library_artifact_key(name, commit, kwargs),
+            )
+        ):
+            return commit
+        return None
+
+    def _fetch(sources):
+        if offline:
+            missing = [
+                s["name"]
+                for s in sources
+                if not os.path.isdir(os.path.join(src_dir, s["dest"]))
+            ]
+            if missing:
+                error_and_die(
+                    "Can't build offline, these haven't been fetched: "
+                    + ", ".join(missing)
+                )
+            return
+        fetch_sources(
+            sources,
+            src_dir,
+            workers=fetch_jobs,
+            depth=clone_depth,
+            blobless=blobless,
+            git_mirror=git_mirror,
+        )
+        # A shallow fetch only brought in the first revision.
+        for rev, sha in zip(revs[1:], openmw_shas[1:]):
+            if fetch_only and pull and is_branch(rev):
+                fetch_repo(openmw_src, rev, depth=clone_depth)
+            elif not rev_exists(openmw_src, sha or rev):
+                fetch_repo(openmw_src, sha or rev, depth=clone_depth)
+
+    def _stale(name, kwargs, stamp):
+        if kwargs["force"]:
+            return "forced"
+        return stale_stamp(
+            kwargs["check_file"],
+            os.path.join(install_prefix, name, STAMP_FILE),
+            stamp,
+        )
+
+    def _adopt(name, kwargs, stamp):
+        adopt_stamp(
+            kwargs["check_file"],
+            os.path.join(install_prefix, name, STAMP_FILE),
+            stamp,
+        )
+
+    def _package(openmw):
+        emit_log("Packaging {0} with {1} ...".format(openmw, pkg_compression))
+        debug_dir = os.path.join(
+            base_prefix if pkg_cpu_profiles else install_prefix,
+            openmw + DEBUG_DIR_SUFFIX,
+        )
+        for profile in pkg_cpu_profiles:
+            if not os.path.isdir(os.path.join(base_prefix, profile, openmw)):
+                error_and_die(
+                    "There's no {0} for the {1} CPU profile, build it with '--cpu-profile {1}' first!".format(
+                        openmw, profile
+                    )
+                )
+        with timed_phase(openmw, "package"):
+            tarballs = make_package(
+                base_prefix if pkg_cpu_profiles else install_prefix,
+                openmw,
+                deps,
+                out_dir,
+                compression=pkg_compression,
+                threads=cpus,
+                with_debug=with_debug,
+                profiles=pkg_cpu_profiles,
+                debug_dir=(
+                    debug_dir if with_debug and os.path.isdir(debug_dir) else None
+                ),
+            )
+        for tarball in tarballs:
+            emit_log(
+                "Package written to: {0} ({1:.1f} MiB)".format(
+                    tarball, os.path.getsize(tarball) / (1024 * 1024)
+                )
+            )
+
+    def _tidy(current):
+        if dedupe:
+            store_dir = os.path.join(install_prefix, STORE_DIR)
+            with timed_phase("store", "dedupe"):
+                for entry in manifest.values():
+                    if entry.get("deduplicated"):
+                        continue
+                    tree = os.path.join(install_prefix, entry["dir"])
+                    linked, freed = store_tree(store_dir, tree, threads=cpus)
+                    entry["deduplicated"] = True
+                    emit_log(
+                        "{0}: {1} files were already stored, {2:.1f} MiB freed".format(
+                            entry["dir"], linked, freed / (1024 * 1024)
+                        )
+                    )
+            write_manifest(install_prefix, manifest)
+        if gc:
+            with timed_phase("store", "gc"):
+                removed, freed = collect_garbage(
+                    install_prefix, manifest, gc_keep, current
+                )
+            write_manifest(install_prefix, manifest)
+            for d in removed:
+                emit_log("Removed old build: " + d)
+            emit_log(
+                "{0} old builds removed, {1:.1f} MiB freed from the store".format(
+                    len(removed), freed / (1024 * 1024)
+                )
+            )
+
+    openmw_kwargs = dict(
+        # OpenMW itself gets a new openmw-<sha> tree for every build.
+        artifact_cache=None,
+        cmake_args=merge_flag_args(build_args),
+        dwp=dwp,
         env=build_env,
         force=force_openmw,
-        git_url="https://github.com/OpenMW/openmw.git",
-        install_prefix=install_prefix,
+        git_url=OPENMW_GIT_URL,
         patch=patch,
-        src_dir=src_dir,
-        verbose=verbose,
-        version=rev,
-    )
-    os.chdir(install_prefix)
-    # Don't fetch updates since new ones might exist
-    openmw_sha = get_repo_sha(src_dir, rev=rev, pull=False, verbose=verbose)
-    os.chdir(install_prefix)
-    if str(openmw_sha) not in openmw:
-        os.rename("openmw", "openmw-{}".format(openmw_sha))
-    if os.path.islink("openmw"):
-        os.remove("openmw")
-    os.symlink("openmw-" + openmw_sha, "openmw")
+    )
+    if pgo:
+        # A profile only applies to objects built at the same paths as the
+        # instrumented ones, which a build root can't promise.
+        openmw_kwargs["build_root"] = None
+
+    def _openmw_kwargs(sha):
+        if not pgo:
+            return openmw_kwargs
+        # The profile's path is part of the args, so a PGO build of a commit
+        # is told apart from a plain one by its stamp.
+        profile_dir = os.path.join(install_prefix, PGO_DIR, sha)
+        cmake_args = build_args + pgo_args(profile_dir, clang, use=True)
+        if pgo_bolt:
+            cmake_args.append("-DCMAKE_EXE_LINKER_FLAGS=-Wl,--emit-relocs")
+        return dict(openmw_kwargs, cmake_args=merge_flag_args(cmake_args))
+
+    def _installed(sha):
+        installed = installed_openmw(install_prefix, sha, manifest)
+        if not installed:
+            return None
+        kwargs = dict(
+            _openmw_kwargs(sha),
+            check_file=os.path.join(install_prefix, installed, "bin", "openmw"),
+        )
+        stamp = library_stamp(installed, sha, kwargs, stamps)
+        if _stale(installed, kwargs, stamp):
+            return None
+        _adopt(installed, kwargs, stamp)
+        return installed
+
+    def _record_tag(sha, rev):
+        """Give an installed build the release tag it was asked for by, if it has none."""
+        entry = manifest.get(sha)
+        if entry and is_release(rev) and not is_release(entry["rev"]):
+            # '--gc' keeps builds of releases.
+            entry["rev"] = rev
+            return True
+        return False
+
+    def _plan():
+        rows = []
+        packages_stamp = os.path.join(install_prefix, PACKAGES_STAMP)
+        if (
+            not skip_install_pkgs
+            and (read_stamp(packages_stamp) or {}).get("key") != packages_key()
+        ):
+            rows.append(("packages", "not checked yet", ["install missing ones"]))
+        for name, job in jobs.items():
+            kwargs = job["kwargs"]
+            reason = _stale(name, kwargs, stamps[name])
+            if not reason:
+                rows.append((name, "up to date", []))
+                continue
+            lib_src = os.path.join(src_dir, name)
+            actions = []
+            if (
+                kwargs["artifact_cache"]
+                and not kwargs["force"]
+                and _cached_commit(name, kwargs)
+            ):
+                actions.append("restore from the artifact cache")
+            else:
+                if not os.path.isdir(lib_src):
+                    actions.append("clone")
+                elif kwargs["force"] or not stamps[name]["commit"]:
+                    actions.append("fetch")
+                actions += ["configure", "compile", "install"]
+            rows.append((name, reason, actions))
+        for rev, sha in zip(revs, openmw_shas):
+            if not sha:
+                # Without pulling, or with nothing to ask upstream from yet,
+                # only a fetch can tell.
+                asked = (
+                    pull
+                    and not looks_like_sha(rev)
+                    and (
+                        os.path.isdir(openmw_src)
+                        or "/" not in rev
+                        or rev.startswith("origin/")
+                    )
+                )
+                if asked:
+                    rows.append((rev, "not found upstream", []))
+                else:
+                    rows.append((rev, "not fetched", ["fetch"]))
+                continue
+            openmw = installed_openmw(install_prefix, sha, manifest)
+            openmw = openmw or "openmw-" + sha[:7]
+            kwargs = _openmw_kwargs(sha)
+            reason = _stale(
+                openmw,
+                dict(
+                    kwargs,
+                    check_file=os.path.join(install_prefix, openmw, "bin", "openmw"),
+                ),
+                library_stamp(openmw, sha, kwargs, stamps),
+            )
+            actions = []
+            if not (os.path.isdir(openmw_src) and rev_exists(openmw_src, sha)):
+                actions.append("fetch")
+            if reason:
+                trained = os.path.join(install_prefix, PGO_DIR, sha, PGO_TRAINED)
+                if pgo and not os.path.isfile(trained):
+                    actions += ["instrumented build", "train"]
+                actions += ["configure", "compile", "install"]
+                if pgo_bolt:
+                    actions.append("bolt")
+            if make_pkg:
+                actions.append("package")
+            rows.append((openmw, reason or "up to date", actions))
+        for name, reason, actions in rows:
+            print(
+                "{0:<20} {1:<28} {2}".format(
+                    name, reason, ", ".join(actions) if actions else "-"
+                )
+            )
+
+    stamps = _stamps()
+    for rev, sha in zip(revs, openmw_shas):
+        if sha:
+            emit_log("{0} resolves to {1}".format(rev, sha))
+    if plan:
+        _plan()
+        return
+    if fetch_only:
+        # Nothing but git is needed to stage sources, not packages, a
+        # compiler cache, or the build farm.  Branches are always brought up
+        # to their tips, since an '--offline' build will only see what's here.
+        _fetch(
+            [
+                {
+                    "name": "openmw",
+                    "dest": "openmw",
+                    "git_url": OPENMW_GIT_URL,
+                    "rev": (
+                        revs[0] if is_branch(revs[0]) else openmw_shas[0] or revs[0]
+                    ),
+                    "update": pull
+                    and (
+                        is_branch(revs[0])
+                        or not (
+                            openmw_shas[0] and rev_exists(openmw_src, openmw_shas[0])
+                        )
+                    ),
+                }
+            ]
+            + [
+                {
+                    "name": name,
+                    "dest": name,
+                    "git_url": job["kwargs"]["git_url"],
+                    "rev": job["kwargs"].get("version", "master"),
+                    "update": job["kwargs"]["force"]
+                    or pull
+                    and is_branch(job["kwargs"].get("version", "master")),
+                }
+                for name, job in jobs.items()
+            ]
+        )
+        emit_log("All sources have been fetched")
+        return
+    if all(openmw_shas):
+        deps_ok = not any(
+            _stale(name, job["kwargs"], stamps[name]) for name, job in jobs.items()
+        )
+        installed = [_installed(sha) for sha in openmw_shas] if deps_ok else [None]
+        if all(installed):
+            for name, job in jobs.items():
+                _adopt(name, job["kwargs"], stamps[name])
+            if any([_record_tag(sha, rev) for rev, sha in zip(revs, openmw_shas)]):
+                write_manifest(install_prefix, manifest)
+            link_openmw(install_prefix, installed[0])
+            for openmw in installed:
+                emit_log("{} is already installed, nothing to do".format(openmw))
+            _tidy(installed[0])
+            if make_pkg:
+                for openmw in installed:
+                    _package(openmw)
+            return
+
+    packages_stamp = os.path.join(install_prefix, PACKAGES_STAMP)
+    if (
+        not skip_install_pkgs
+        and (read_stamp(packages_stamp) or {}).get("key") == packages_key()
+    ):
+        emit_log("All needed packages were installed as of the last run")
+        skip_install_pkgs = True
+
+    if not skip_install_pkgs:
+        try:
+            out, err = get_distro()
+            if err:
+                error_and_die(err.decode())
+        except FileNotFoundError:
+            error_and_die(
+                "Unable to determine your distro to install dependencies!  Try again and use '-S' if you know what you are doing."
+            )
+        distro = out.decode().split(":")[1].strip()
+        ensure_dir(os.path.join(install_prefix, "logs"))
+        with timed_phase("packages", "install"):
+            result = install_packages(
+                distro,
+                verbose=verbose,
+                log_file=os.path.join(install_prefix, "logs", "packages.log"),
+            )
+        if result and result[1]:
+            # Isn't always necessarily exit-worthy
+            emit_log("Stderr received: " + result[1].decode())
+        name, pkgs, manager = distro_packages(distro)
+        if not result or not missing_packages(manager, pkgs):
+            write_stamp(packages_stamp, {"key": packages_key(), "distro": distro})
+
+    cache_env = {}
+    if compiler_cache:
+        if not compiler_cache_dir:
+            ensure_dir(os.path.join(install_prefix, "cache"))
+            compiler_cache_dir = os.path.join(install_prefix, "cache", compiler_cache)
+        ensure_dir(compiler_cache_dir)
+        cache_env = compiler_cache_env(
+            compiler_cache, compiler_cache_dir, compiler_cache_size
+        )
+        # Every build, and the sccache server, should see the same cache.
+        os.environ.update(cache_env)
+        if compiler_cache == "sccache":
+            execute_shell(["sccache", "--start-server"])
+
+    farm_env = {}
+    farm_jobs = 0
+    if farm_workers:
+        hosts, farm_jobs = farm_hosts(farm_workers)
+        if hosts:
+            farm_env["DISTCC_HOSTS"] = hosts
+            os.environ.update(farm_env)
+        else:
+            emit_log(
+                "No build farm workers are free, compiling here", level=logging.WARN
+            )
+            farm = None
+    if farm and "osg-openmw" in jobs:
+        # OSG and OpenMW are where nearly all the compile time goes.
+        jobs["osg-openmw"]["kwargs"].update(farm=farm, farm_jobs=farm_jobs)
+
+    # Get all the sources first, at once, so none of the builds have to.
+    sources = [
+        {
+            "name": "openmw",
+            "dest": "openmw",
+            "git_url": OPENMW_GIT_URL,
+            "rev": openmw_shas[0] or revs[0],
+            # The remote already said where each rev is; only fetch if one of
+            # those commits isn't here yet.
+            "update": pull
+            and not (
+                all(openmw_shas)
+                and os.path.isdir(openmw_src)
+                and all(rev_exists(openmw_src, sha) for sha in openmw_shas)
+            ),
+        }
+    ]
+    cached = {}
+    for name, job in jobs.items():
+        kwargs = job["kwargs"]
+        if not _stale(name, kwargs, stamps[name]):
+            continue
+        if kwargs["artifact_cache"] and not kwargs["force"]:
+            # Libraries that are in the artifact cache at the commit they'd
+            # build don't need their sources at all.
+            cached[name] = _cached_commit(name, kwargs)
+            if cached[name]:
+                kwargs["commit"] = cached[name]
+                continue
+        sources.append(
+            {
+                "name": name,
+                "dest": name,
+                "git_url": kwargs["git_url"],
+                "rev": kwargs.get("version", "master"),
+                "update": kwargs["force"],
+            }
+        )
+    _fetch(sources)
+
+    # OPENMW
+    build_env.update(cache_env)
+    build_env.update(farm_env)
+    for job in jobs.values():
+        # Recipes built against others have an env of their own.
+        if job["kwargs"].get("env") is not None:
+            job["kwargs"]["env"].update(cache_env)
+            job["kwargs"]["env"].update(farm_env)
+    # Sources that were just fetched may resolve to new commits.
+    stamps = _stamps(cached)
+    for name, job in jobs.items():
+        job["kwargs"]["stamp"] = stamps[name]
+
+    builds = collections.OrderedDict()
+    for rev, sha in zip(revs, openmw_shas):
+        if not sha:
+            sha = resolve_revision(openmw_src, rev, remote=False)
+            if not sha:
+                error_and_die("Can't find the OpenMW rev: " + rev)
+        if sha in builds:
+            continue
+        openmw = installed_openmw(install_prefix, sha, manifest)
+        if not openmw:
+            short = execute_shell(["git", "rev-parse", "--short", sha], cwd=openmw_src)
+            openmw = "openmw-" + short[1][0].decode().strip()
+        # The first revision builds in the main checkout, others each get a
+        # worktree of their own, so they can build at the same time.
+        clone_dest = "openmw"
+        if builds:
+            clone_dest = "openmw-worktree-{}".format(len(builds) + 1)
+            if not os.path.isdir(os.path.join(src_dir, clone_dest)):
+                execute_shell(["git", "worktree", "prune"], cwd=openmw_src)
+                exitcode, output = execute_shell(
+                    [
+                        "git",
+                        "worktree",
+                        "add",
+                        "--detach",
+                        os.path.join(src_dir, clone_dest),
+                        sha,
+                    ],
+                    cwd=openmw_src,
+                )
+                if exitcode != 0:
+                    error_and_die(
+                        "Could not make a worktree for {0}: {1}".format(
+                            rev, output[1].decode()
+                        )
+                    )
+        builds[sha] = (openmw, rev)
+        kwargs = _openmw_kwargs(sha)
+        check_file = os.path.join(install_prefix, openmw, "bin", "openmw")
+        stamp = library_stamp(openmw, sha, kwargs, stamps)
+        openmw_deps = deps
+        profile_dir = os.path.join(install_prefix, PGO_DIR, sha)
+        rebuild_pgo = pgo and _stale(openmw, dict(kwargs, check_file=check_file), stamp)
+        if rebuild_pgo:
+            os.makedirs(profile_dir, exist_ok=True)
+            if not os.path.isfile(os.path.join(profile_dir, PGO_TRAINED)):
+                # Build an instrumented OpenMW from the same tree, so object
+                # paths match the ones in the profile, then train it.
+                add_job(
+                    openmw + "-pgo",
+                    deps=deps,
+                    weight=4,
+                    check_file=os.path.join(
+                        install_prefix, openmw + "-pgo", "bin", "openmw"
+                    ),
+                    clone_dest=clone_dest,
+                    farm=farm,
+                    farm_jobs=farm_jobs,
+                    version=sha,
+                    **dict(
+                        openmw_kwargs,
+                        cmake_args=merge_flag_args(
+                            build_args
+                            + ["-DOPENMW_LTO_BUILD=off"]
+                            + pgo_args(profile_dir, clang, use=False)
+                        ),
+                        force=True,
+                    )
+                )
+                jobs[openmw + "-train"] = {
+                    "deps": [openmw + "-pgo"],
+                    "weight": 1,
+                    "kwargs": dict(
+                        command=pgo,
+                        openmw_dir=os.path.join(install_prefix, openmw + "-pgo"),
+                        profile_dir=profile_dir,
+                        clang=clang,
+                    ),
+                    "run": pgo_train,
+                }
+                openmw_deps = deps + [openmw + "-train"]
+            else:
+                emit_log("Using the cached profile for " + sha)
+        add_job(
+            openmw,
+            deps=openmw_deps,
+            weight=4,
+            check_file=check_file,
+            clone_dest=clone_dest,
+            debug_dir=(
+                os.path.join(install_prefix, openmw + DEBUG_DIR_SUFFIX)
+                if with_debug and debug_info != "inline"
+                else None
+            ),
+            farm=farm,
+            farm_jobs=farm_jobs,
+            stamp=stamp,
+            version=sha,
+            **kwargs
+        )
+        if pgo_bolt and rebuild_pgo:
+            jobs[openmw + "-bolt"] = {
+                "deps": [openmw],
+                "weight": 1,
+                "kwargs": dict(
+                    command=pgo,
+                    openmw_dir=os.path.join(install_prefix, openmw),
+                    profile_dir=profile_dir,
+                ),
+                "run": bolt_optimize,
+            }
+    # sccache can't tell one build's compiles from another's, so it only
+    # gets a total for the whole run.
+    cache_counts = compiler_cache == "sccache" and sccache_counts()
+    schedule_builds(jobs, cpus, max_parallel=parallel_builds, memory=available_memory())
+    if cache_counts:
+        after = sccache_counts()
+        if after:
+            log_cache_counts(
+                "This run's", "sccache", *(a - b for a, b in zip(after, cache_counts))
+            )
+
+    for sha, (openmw, rev) in builds.items():
+        seconds = library_seconds(openmw)
+        if not seconds and sha in manifest:
+            # It was already installed.
+            _record_tag(sha, rev)
+            continue
+        previous = [
+            e
+            for e in sorted(manifest.values(), key=lambda e: e["installed"])
+            if e.get("build_seconds") and e.get("fast_compile", False) != fast_compile
+        ]
+        manifest[sha] = {
+            "dir": openmw,
+            "rev": rev,
+            "installed": datetime.datetime.now().isoformat(timespec="seconds"),
+            "build_seconds": round(seconds, 1),
+            "fast_compile": fast_compile,
+            "pgo": bool(pgo),
+        }
+        if seconds and previous:
+            emit_log(
+                "{0} took {1:.1f}s to build; {2}, the last build {3} '--fast-compile', took {4:.1f}s".format(
+                    openmw,
+                    seconds,
+                    previous[-1]["dir"],
+                    "with" if not fast_compile else "without",
+                    previous[-1]["build_seconds"],
+                )
+            )
+    write_manifest(install_prefix, manifest)
+    current = next(iter(builds.values()))[0]
+    link_openmw(install_prefix, current)
+    _tidy(current)
+    if make_pkg:
+        for openmw, rev in builds.values():
+            _package(openmw)
 
     end = datetime.datetime.now()
     duration = end - start
@@ -962,6 +4411,31 @@ def main() -> None:
     seconds = int(duration.total_seconds() % 60)
     emit_log("Took {m} minutes, {s} seconds.".format(m=minutes, s=seconds))
 
+    reports_dir = os.path.join(install_prefix, "logs", "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+    report_file = os.path.join(
+        reports_dir, "build-{}.json".format(start.strftime("%Y%m%d-%H%M%S"))
+    )
+    phases = write_report(report_file, start, sys.argv[1:])
+    emit_log("Build report written to: " + report_file)
+    if show_report:
+        emit_log(
+            "{0:<24} {1:<10} {2:>9} {3:>9} {4:>9}  {5}".format(
+                "library", "phase", "wall (s)", "cpu (s)", "peak MiB", "exit codes"
+            )
+        )
+        for r in phases:
+            emit_log(
+                "{0:<24} {1:<10} {2:>9.1f} {3:>9.1f} {4:>9}  {5}".format(
+                    r["lib"],
+                    r["phase"],
+                    r["seconds"],
+                    r["cpu_seconds"],
+                    r["max_rss_kb"] // 1024,
+                    ",".join(str(c) for c in sorted(set(r["exit_codes"]))) or "-",
+                )
+            )
+
 
 if __name__ == "__main__":
     try: